@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, List, Dict, Any, Optional, Set
+
+from notion_client import AsyncClient
+from notion_client.errors import RequestTimeoutError
+
+from app.notion_caches import NotionCaches
+from app.notion_clients import notion_call_deadline
+from app.notion_database_directory import NotionDatabaseDirectory, rank_entries
+from app.notion_page_index import NotionPageTitleIndex
+from app.notion_ops import (
+    DATABASE_FILTER,
+    LAST_EDITED_DESC,
+    build_database_options,
+    build_input_blocks,
+    find_related_database_id,
+    search_database_options,
+    search_property_options,
+    search_relation_options,
+    strip_generation,
+)
+from app.rate_limiter import TokenBucket
+
+# asyncio only keeps weak references to tasks, so hold the background ones until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+async def find_notion_database(notion: AsyncClient, database_id: str) -> dict:
+    return await notion.databases.retrieve(database_id=database_id)
+
+
+async def find_notion_database_form(notion: AsyncClient, caches: NotionCaches, database_id: str) -> Dict[str, Any]:
+    # The caches read and write the shared store, which is blocking I/O
+    cached = await asyncio.to_thread(caches.find_database_form, database_id)
+    if cached is not None:
+        return cached
+    database = await find_notion_database(notion, database_id)
+    return await asyncio.to_thread(caches.schemas.put, database, build_input_blocks(database))
+
+
+def prefetch_notion_database_forms(
+    notion: AsyncClient,
+    caches: NotionCaches,
+    database_ids: List[str],
+    rate_limiter: Optional[TokenBucket],
+    logger: logging.Logger,
+) -> None:
+    for database_id in database_ids:
+        if not caches.begin_prefetch(database_id):
+            continue
+
+        async def run(database_id: str = database_id):
+            try:
+                if await asyncio.to_thread(caches.find_database_form, database_id) is not None:
+                    return
+                # Prefetching is best-effort, so it never waits for the rate limiter
+                if rate_limiter is not None and not rate_limiter.try_acquire():
+                    return
+                await find_notion_database_form(notion, caches, database_id)
+            except Exception as e:
+                logger.debug(f"Failed to prefetch a Notion database (id: {database_id}, error: {e})")
+            finally:
+                caches.end_prefetch(database_id)
+
+        task = asyncio.create_task(run())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def iter_notion_databases(
+    notion: AsyncClient,
+    query: Optional[str] = None,
+    sort: Optional[dict] = None,
+    deadline: Optional[float] = None,
+) -> AsyncIterator[dict]:
+    params = {"filter": DATABASE_FILTER}
+    if query:
+        params["query"] = query
+    if sort is not None:
+        params["sort"] = sort
+    cursor = None
+    while deadline is None or time.monotonic() < deadline:
+        try:
+            with notion_call_deadline(deadline):
+                page = await notion.search(**params, start_cursor=cursor)
+        except RequestTimeoutError:
+            if deadline is None:
+                raise
+            # The time budget ran out while Notion was still searching
+            return
+        for database in page["results"]:
+            yield database
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
+
+
+async def sync_notion_database_directory(notion: AsyncClient, directory: NotionDatabaseDirectory) -> None:
+    if directory.needs_full_sync():
+        databases = [d async for d in iter_notion_databases(notion)]
+        # Saving the snapshot to the shared store is blocking I/O
+        await asyncio.to_thread(directory.replace_all, databases)
+        return
+
+    watermark = directory.watermark
+    updated = []
+    async for database in iter_notion_databases(notion, sort=LAST_EDITED_DESC):
+        if watermark is not None and database["last_edited_time"] < watermark:
+            break
+        updated.append(database)
+    await asyncio.to_thread(directory.upsert, updated)
+
+
+async def search_notion_databases(
+    notion: AsyncClient,
+    query: Optional[str],
+    deadline: float,
+    limit: int = 100,
+) -> List[dict]:
+    databases = []
+    sort = None if query else LAST_EDITED_DESC
+    async for database in iter_notion_databases(notion, query=query, sort=sort, deadline=deadline):
+        databases.append(database)
+        if len(databases) >= limit:
+            break
+    return databases
+
+
+def refresh_notion_database_directory(notion: AsyncClient, directory: NotionDatabaseDirectory, logger: logging.Logger):
+    if not directory.is_stale():
+        return
+
+    async def run():
+        # Claiming the refresh reads the shared store, so it runs in a thread as well
+        if not await asyncio.to_thread(directory.begin_refresh):
+            return
+        try:
+            await sync_notion_database_directory(notion, directory)
+        except Exception as e:
+            logger.warning(f"Failed to refresh the Notion database directory (error: {e})")
+        finally:
+            await asyncio.to_thread(directory.end_refresh)
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def build_notion_database_options(
+    notion: AsyncClient,
+    directory: NotionDatabaseDirectory,
+    payload: dict,
+    logger: logging.Logger,
+    time_budget_seconds: float = 2.0,
+) -> List[Dict[str, Any]]:
+    refresh_notion_database_directory(notion, directory, logger)
+    if directory.is_loaded:
+        return search_database_options(directory, payload)
+
+    deadline = time.monotonic() + time_budget_seconds
+    databases = await search_notion_databases(notion, payload.get("value"), deadline)
+    return build_database_options(rank_entries([directory.to_entry(d) for d in databases], payload.get("value")))
+
+
+async def build_notion_property_options(
+    notion: AsyncClient,
+    caches: NotionCaches,
+    payload: dict,
+) -> List[Dict[str, Any]]:
+    database_id = json.loads(payload["view"]["private_metadata"])["notion_database_id"]
+    form = await find_notion_database_form(notion, caches, database_id)
+    return search_property_options(form, payload)
+
+
+async def sync_notion_page_index(notion: AsyncClient, database_id: str, index: NotionPageTitleIndex) -> None:
+    if index.needs_full_sync():
+        pages = []
+        cursor = None
+        while True:
+            page = await notion.databases.query(database_id=database_id, start_cursor=cursor, page_size=100)
+            pages.extend(page["results"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        await asyncio.to_thread(index.replace_all, pages)
+        return
+
+    query = {"database_id": database_id, "page_size": 100}
+    if index.watermark is not None:
+        query["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": index.watermark}}
+    cursor = None
+    while True:
+        page = await notion.databases.query(**query, start_cursor=cursor)
+        await asyncio.to_thread(index.upsert, page["results"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+
+async def search_notion_pages(
+    notion: AsyncClient,
+    database_id: str,
+    query: Optional[str],
+    deadline: float,
+    limit: int = 100,
+) -> List[dict]:
+    params: Dict[str, Any] = {"database_id": database_id, "page_size": 100}
+    if query:
+        params["filter"] = {"property": "title", "title": {"contains": query}}
+    else:
+        params["sorts"] = [LAST_EDITED_DESC]
+    pages = []
+    cursor = None
+    while time.monotonic() < deadline and len(pages) < limit:
+        try:
+            with notion_call_deadline(deadline):
+                page = await notion.databases.query(**params, start_cursor=cursor)
+        except RequestTimeoutError:
+            # The time budget ran out while Notion was still querying
+            break
+        pages.extend(page["results"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    return pages[:limit]
+
+
+def refresh_notion_page_index(
+    notion: AsyncClient,
+    database_id: str,
+    index: NotionPageTitleIndex,
+    logger: logging.Logger,
+):
+    if not index.is_stale():
+        return
+
+    async def run():
+        if not await asyncio.to_thread(index.begin_refresh):
+            return
+        try:
+            await sync_notion_page_index(notion, database_id, index)
+        except Exception as e:
+            logger.warning(f"Failed to refresh the page index of a Notion database (id: {database_id}, error: {e})")
+        finally:
+            await asyncio.to_thread(index.end_refresh)
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def build_notion_relation_options(
+    notion: AsyncClient,
+    caches: NotionCaches,
+    payload: dict,
+    logger: logging.Logger,
+    time_budget_seconds: float = 2.0,
+) -> List[Dict[str, Any]]:
+    database_id = json.loads(payload["view"]["private_metadata"])["notion_database_id"]
+    form = await find_notion_database_form(notion, caches, database_id)
+    related_database_id = find_related_database_id(form["database"], strip_generation(payload["block_id"]))
+    if related_database_id is None:
+        return []
+    index = caches.page_index(related_database_id)
+    refresh_notion_page_index(notion, related_database_id, index, logger)
+    if index.is_loaded:
+        return search_relation_options(index, payload)
+
+    deadline = time.monotonic() + time_budget_seconds
+    pages = await search_notion_pages(notion, related_database_id, payload.get("value"), deadline)
+    return build_database_options(rank_entries([index.to_entry(p) for p in pages], payload.get("value")))
@@ -0,0 +1,386 @@
+import asyncio
+import json
+import logging
+import random
+from typing import Optional, Set
+
+from slack_bolt.async_app import AsyncApp, AsyncAck, AsyncSay, AsyncBoltContext
+from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.async_notion_ops import (
+    find_notion_database_form,
+    build_notion_database_options,
+    build_notion_property_options,
+    build_notion_relation_options,
+    prefetch_notion_database_forms,
+)
+from app.home_tab import HomeTabPublisher
+from app.metrics import Metrics, listener_name, summarize_request, instrument_async_web_client, time_async_lazy_listener
+from app.notion_caches import NotionCachesRegistry
+from app.notion_clients import AsyncNotionClientRegistry
+from app.notion_csv_import import NotionCsvImporter
+from app.notion_write_queue import NotionWriteQueue
+from app.rate_limiter import TokenBucketRegistry
+from app.slack_views import (
+    build_home_view,
+    build_database_selection_view,
+    build_csv_import_view,
+    find_csv_file,
+    build_message_view,
+    build_send_to_notion_view,
+    build_message_source,
+    selected_message_source,
+    selected_database_id,
+    view_submission_key,
+    is_batch_mode,
+    view_batch_id,
+    build_next_row_view,
+    submitted_state_values,
+    build_saved_message,
+    validate_send_to_notion_submission,
+    LOADING_DATABASE_MESSAGE,
+    LOADING_DATABASE_FAILED_MESSAGE,
+    SENDING_DATA_MESSAGE,
+    SENDING_DATA_FAILED_MESSAGE,
+    NO_CSV_FILE_MESSAGE,
+    CSV_IMPORT_STARTED_MESSAGE,
+)
+
+
+def register_async_slack_event_handlers(
+    app: AsyncApp,
+    notion_clients: AsyncNotionClientRegistry,
+    notion_caches: NotionCachesRegistry,
+    notion_write_queue: NotionWriteQueue,
+    notion_csv_importer: NotionCsvImporter,
+    notion_rate_limiters: TokenBucketRegistry,
+    schema_prefetch_size: int = 3,
+    metrics: Optional[Metrics] = None,
+    body_log_sample_rate: float = 0.0,
+    options_time_budget_seconds: float = 2.0,
+    home_tab_publisher: Optional[HomeTabPublisher] = None,
+):
+    @app.middleware
+    async def log_and_time_request(body: dict, context: AsyncBoltContext, logger: logging.Logger, next_):
+        # Logging every request body is too expensive under load, so only a sample of them is logged
+        if body_log_sample_rate > 0 and random.random() < body_log_sample_rate:
+            logger.info(json.dumps(summarize_request(body, context)))
+        if metrics is None:
+            await next_()
+            return
+        context["client"] = instrument_async_web_client(context.client, metrics)
+        # Bolt returns from next_() once ack() is done; lazy listeners are timed by time_async_lazy_listener
+        with metrics.slack_ack_seconds.time(listener=listener_name(body)):
+            await next_()
+
+    #
+    # Home tab
+    #
+
+    @app.event("app_home_opened")
+    async def update_home_tab(client: AsyncWebClient, context: AsyncBoltContext, event: dict):
+        if home_tab_publisher is None:
+            await client.views_publish(user_id=context.user_id, view=build_home_view())
+            return
+        key = (context.enterprise_id, context.team_id, context.user_id)
+        if event.get("view") is None:
+            # The user sees no view published by this app, so the one remembered for them is stale
+            await asyncio.to_thread(home_tab_publisher.forget, key)
+        # The publisher runs in its own thread, so it gets a client of its own
+        publisher_client = WebClient(token=context.bot_token, base_url=client.base_url)
+        await asyncio.to_thread(home_tab_publisher.publish, publisher_client, key, build_home_view())
+
+    #
+    # Send to Notion
+    #
+
+    def resolve_notion_token(context: AsyncBoltContext) -> str:
+        token = context.get("notion_token")
+        if token is None:
+            raise Exception("Unexpectedly Notion installation is not found!")
+        return token
+
+    @app.action("link-button")
+    async def just_ack_link_buttons(ack: AsyncAck):
+        await ack()
+
+    @app.shortcut("open-notion-form")
+    @app.action("open-notion-form")
+    @app.command("/send-to-notion")
+    async def open_notion_form(ack: AsyncAck, client: AsyncWebClient, body: dict):
+        await ack()
+        await client.views_open(
+            trigger_id=body["trigger_id"],
+            view=build_database_selection_view(),
+        )
+
+    @app.action("select-notion-workspace")
+    async def select_notion_workspace(ack: AsyncAck, body: dict, client: AsyncWebClient):
+        await ack()
+        await client.views_update(
+            view_id=body.get("view").get("id"),
+            view=build_database_selection_view(),
+        )
+
+    @app.action("go-back-to-database-select-view")
+    async def go_back_to_initial_modal_view(ack: AsyncAck, client: AsyncWebClient, body: dict, context: AsyncBoltContext):
+        await ack()
+        await client.views_update(
+            view_id=body["view"]["id"],
+            hash=body["view"]["hash"],
+            view=build_database_selection_view(selected_message_source(body["view"])),
+        )
+        batch_id = json.loads(body["view"].get("private_metadata") or "{}").get("batch_id")
+        if batch_id is not None:
+            # Leaving the form ends its batch entry, just like closing it
+            await asyncio.to_thread(
+                notion_write_queue.close_batch,
+                batch_id=batch_id,
+                enterprise_id=context.enterprise_id,
+                team_id=context.team_id,
+                user_id=context.user_id,
+            )
+
+    @app.shortcut("send-message-to-notion")
+    async def open_message_export_form(ack: AsyncAck, client: AsyncWebClient, body: dict):
+        await ack()
+        await client.views_open(
+            trigger_id=body["trigger_id"],
+            view=build_database_selection_view(build_message_source(body["channel"]["id"], body["message"])),
+        )
+
+    @app.options("search-notion-database")
+    async def search_notion_database(
+        ack: AsyncAck,
+        payload: dict,
+        context: AsyncBoltContext,
+        logger: logging.Logger,
+    ):
+        notion_token = resolve_notion_token(context)
+        notion = notion_clients.get(notion_token)
+        directory = notion_caches.get(notion_token).database_directory
+        options = await build_notion_database_options(notion, directory, payload, logger, options_time_budget_seconds)
+        await ack(options=options)
+        # The user is likely to pick one of the top results, so load their forms before they click Next
+        prefetch_notion_database_forms(
+            notion,
+            notion_caches.get(notion_token),
+            [o["value"] for o in options[:schema_prefetch_size]],
+            notion_rate_limiters.get(notion_token),
+            logger,
+        )
+
+    @app.options("select")
+    @app.options("multi_select")
+    async def search_notion_property_options(ack: AsyncAck, payload: dict, context: AsyncBoltContext):
+        notion_token = resolve_notion_token(context)
+        notion = notion_clients.get(notion_token)
+        options = await build_notion_property_options(notion, notion_caches.get(notion_token), payload)
+        await ack(options=options)
+
+    @app.options("relation")
+    async def search_notion_relation_options(
+        ack: AsyncAck,
+        payload: dict,
+        context: AsyncBoltContext,
+        logger: logging.Logger,
+    ):
+        notion_token = resolve_notion_token(context)
+        notion = notion_clients.get(notion_token)
+        options = await build_notion_relation_options(
+            notion, notion_caches.get(notion_token), payload, logger, options_time_budget_seconds
+        )
+        await ack(options=options)
+
+    # Views whose submission was completed in ack() with a cached form.
+    # Bolt still starts their lazy listeners, which have to do nothing.
+    handled_view_ids: Set[str] = set()
+
+    def was_handled_in_ack(view: dict) -> bool:
+        if view["id"] in handled_view_ids:
+            handled_view_ids.remove(view["id"])
+            return True
+        return False
+
+    async def select_notion_database_ack(ack: AsyncAck, view: dict, context: AsyncBoltContext):
+        database_id = selected_database_id(view)
+        cached = await asyncio.to_thread(notion_caches.get(resolve_notion_token(context)).find_database_form, database_id)
+        if cached is not None:
+            # Skip the loading view and the extra views.update call when the form is ready
+            handled_view_ids.add(view["id"])
+            await ack(
+                response_action="update",
+                view=build_send_to_notion_view(database_id, cached["blocks"], selected_message_source(view)),
+            )
+            return
+        await ack(
+            response_action="update",
+            view=build_message_view("select-notion-database", LOADING_DATABASE_MESSAGE),
+        )
+
+    async def select_notion_database_lazy(
+        view: dict,
+        client: AsyncWebClient,
+        say: AsyncSay,
+        context: AsyncBoltContext,
+        logger: logging.Logger,
+    ):
+        if was_handled_in_ack(view):
+            return
+        try:
+            database_id = selected_database_id(view)
+            notion_token = resolve_notion_token(context)
+            notion = notion_clients.get(notion_token)
+            form = await find_notion_database_form(notion, notion_caches.get(notion_token), database_id)
+            blocks = form["blocks"]
+            await client.views_update(
+                view_id=view["id"],
+                view=build_send_to_notion_view(database_id, blocks, selected_message_source(view)),
+            )
+        except Exception as e:
+            logger.exception(e)
+            await client.views_update(
+                view_id=view["id"],
+                view=build_message_view("send-to-notion-database", LOADING_DATABASE_FAILED_MESSAGE),
+            )
+            await say(
+                channel=context.user_id,
+                text=f"I'm sorry for being distracted! This app encountered a problem (error: {e})\n"
+                "Please contact this app's user support email address :bow:",
+            )
+
+    app.view("select-notion-database")(
+        ack=select_notion_database_ack,
+        lazy=[time_async_lazy_listener(select_notion_database_lazy, metrics)],
+    )
+
+    async def sent_to_notion_ack(ack: AsyncAck, view: dict):
+        errors = validate_send_to_notion_submission(view["state"]["values"])
+        if len(errors) > 0:
+            await ack(response_action="errors", errors=errors)
+            return
+        # The store and the queue use SQLite and Slack API calls, so they run off the event loop
+        record = await asyncio.to_thread(notion_write_queue.idempotency_store.find, view_submission_key(view))
+        if record is not None and record.get("page_url") is not None and not is_batch_mode(view):
+            # Slack delivered this submission again after its page was created
+            await ack(
+                response_action="update",
+                view=build_message_view("send-to-notion-database", build_saved_message(record["page_url"])),
+            )
+            return
+
+        if is_batch_mode(view):
+            # The next row can be typed while this one is saved in the background
+            await ack(response_action="update", view=build_next_row_view(view))
+            return
+        await ack(
+            response_action="update",
+            view=build_message_view("send-to-notion-database", SENDING_DATA_MESSAGE),
+        )
+
+    async def sent_to_notion_lazy(
+        view: dict,
+        body: dict,
+        say: AsyncSay,
+        context: AsyncBoltContext,
+        client: AsyncWebClient,
+        logger: logging.Logger,
+    ):
+        errors = validate_send_to_notion_submission(view["state"]["values"])
+        if len(errors) > 0:
+            return
+        try:
+            idempotency_key = view_submission_key(view)
+            if await asyncio.to_thread(notion_write_queue.idempotency_store.claim, idempotency_key) is not None:
+                # The same submission has already been queued, and its write updates the modal
+                logger.info(f"Skipped a repeated submission (view: {view['id']})")
+                return
+            # The modal is updated with the page URL once a queue worker saves the data in Notion,
+            # or the summary is posted when the batch that this row belongs to is finished
+            batch_id = view_batch_id(view)
+            await asyncio.to_thread(
+                notion_write_queue.enqueue,
+                enterprise_id=context.enterprise_id,
+                team_id=context.team_id,
+                user_id=context.user_id,
+                view_id=view["id"],
+                database_id=json.loads(view["private_metadata"])["notion_database_id"],
+                state_values=submitted_state_values(view),
+                message=json.loads(view["private_metadata"]).get("message"),
+                idempotency_key=idempotency_key,
+                batch_id=batch_id,
+            )
+            if batch_id is not None and not is_batch_mode(view):
+                # The last row of the batch
+                await asyncio.to_thread(
+                    notion_write_queue.close_batch,
+                    batch_id=batch_id,
+                    enterprise_id=context.enterprise_id,
+                    team_id=context.team_id,
+                    user_id=context.user_id,
+                    view_id=view["id"],
+                )
+        except Exception as e:
+            logger.exception(e)
+            await client.views_update(
+                view_id=view["id"],
+                view=build_message_view("send-to-notion-database", SENDING_DATA_FAILED_MESSAGE),
+            )
+            await say(
+                channel=context.user_id,
+                text=f"I'm sorry for being distracted! This app failed to send your data to Notion (error: {e})\n"
+                "Please contact this app's user support email address :bow:",
+            )
+
+    app.view("send-to-notion-database")(
+        ack=sent_to_notion_ack,
+        lazy=[time_async_lazy_listener(sent_to_notion_lazy, metrics)],
+    )
+
+    @app.view_closed("send-to-notion-database")
+    async def finish_batch_entry(ack: AsyncAck, view: dict, context: AsyncBoltContext):
+        await ack()
+        batch_id = json.loads(view["private_metadata"]).get("batch_id")
+        if batch_id is not None:
+            await asyncio.to_thread(
+                notion_write_queue.close_batch,
+                batch_id=batch_id,
+                enterprise_id=context.enterprise_id,
+                team_id=context.team_id,
+                user_id=context.user_id,
+            )
+
+    #
+    # Import CSV files
+    #
+
+    @app.shortcut("import-csv-to-notion")
+    async def open_csv_import_form(ack: AsyncAck, client: AsyncWebClient, body: dict):
+        await ack()
+        message = body["message"]
+        file = find_csv_file(message)
+        if file is None:
+            view = build_message_view("import-csv-to-notion", NO_CSV_FILE_MESSAGE)
+        else:
+            view = build_csv_import_view(file, body["channel"]["id"], message.get("thread_ts", message["ts"]))
+        await client.views_open(trigger_id=body["trigger_id"], view=view)
+
+    @app.view("import-csv-to-notion")
+    async def start_csv_import(ack: AsyncAck, view: dict, context: AsyncBoltContext):
+        await ack(
+            response_action="update",
+            view=build_message_view("import-csv-to-notion", CSV_IMPORT_STARTED_MESSAGE),
+        )
+        metadata = json.loads(view["private_metadata"])
+        # The import runs in its own thread as it can take minutes for a large file
+        await asyncio.to_thread(
+            notion_csv_importer.start,
+            notion_token=resolve_notion_token(context),
+            bot_token=context.bot_token,
+            database_id=selected_database_id(view),
+            file=metadata["file"],
+            channel_id=metadata["channel_id"],
+            thread_ts=metadata["thread_ts"],
+            idempotency_key=view_submission_key(view),
+        )
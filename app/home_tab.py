@@ -0,0 +1,124 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from app.installations import LruCache
+from app.rate_limiter import TokenBucketRegistry
+from app.shared_store import SharedStore
+
+# enterprise_id, team_id and user_id
+HomeTabKey = Tuple[Optional[str], Optional[str], str]
+
+
+def view_hash(view: dict) -> str:
+    return hashlib.sha256(json.dumps(view, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class HomeTabPublisher:
+    """Publishes Home tab views from a background thread, skipping the views that users already have.
+
+    The digest of the view last published to each user is kept in an LRU cache, and in the shared
+    store when several processes serve the same workspaces. Publishes are sent under a
+    per-workspace rate limit that honors Retry-After, and a view still waiting to be sent is
+    replaced by a newer one for the same user instead of being sent twice.
+    """
+
+    def __init__(
+        self,
+        rate_limiters: TokenBucketRegistry,
+        cache: Optional[LruCache] = None,
+        store: Optional[SharedStore] = None,
+        store_ttl_seconds: float = 86400,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        self.rate_limiters = rate_limiters
+        self.cache = cache if cache is not None else LruCache(max_entries=10000, ttl_seconds=86400)
+        self.store = store if store is not None else SharedStore()
+        self.store_ttl_seconds = store_ttl_seconds
+        self.logger = logger
+        self._pending: "OrderedDict[HomeTabKey, Tuple[WebClient, dict, str]]" = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="home-tab-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def publish(self, client: WebClient, key: HomeTabKey, view: dict) -> bool:
+        """Queues the view unless the user already has it. Returns False when the publish was skipped."""
+        digest = view_hash(view)
+        if self._published_hash(key) == digest:
+            return False
+        with self._condition:
+            self._pending[key] = (client, view, digest)
+            self._condition.notify()
+        return True
+
+    def forget(self, key: HomeTabKey) -> None:
+        """Makes the next publish for the user go through, for instance when Slack no longer shows them a view."""
+        self.cache.invalidate(key)
+        self.store.put(self._store_key(key), None, ttl_seconds=0)
+
+    def _published_hash(self, key: HomeTabKey) -> Optional[str]:
+        digest = self.cache.get(key)
+        if digest is None:
+            digest = self.store.get(self._store_key(key))
+            if digest is not None:
+                self.cache.put(key, digest)
+        return digest
+
+    @staticmethod
+    def _store_key(key: HomeTabKey) -> str:
+        return f"home_tab:{key[0] or ''}:{key[1] or ''}:{key[2]}"
+
+    def _take_next(self) -> Optional[Tuple[HomeTabKey, WebClient, dict, str]]:
+        # The oldest view whose workspace is within its rate limit goes first
+        with self._condition:
+            for key, (client, view, digest) in self._pending.items():
+                if self.rate_limiters.get(f"{key[0]}:{key[1]}").try_acquire():
+                    del self._pending[key]
+                    return key, client, view, digest
+            return None
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or len(self._pending) > 0)
+                if self._stopped:
+                    return
+            next_publish = self._take_next()
+            if next_publish is None:
+                time.sleep(0.1)
+                continue
+            key, client, view, digest = next_publish
+            try:
+                client.views_publish(user_id=key[2], view=view)
+                self.cache.put(key, digest)
+                self.store.put(self._store_key(key), digest, ttl_seconds=self.store_ttl_seconds)
+            except SlackApiError as e:
+                if e.response.status_code == 429:
+                    retry_after = e.response.headers.get("Retry-After") or e.response.headers.get("retry-after") or 1
+                    self.rate_limiters.get(f"{key[0]}:{key[1]}").pause(float(retry_after))
+                    with self._condition:
+                        # Sent again later unless a newer view has been queued in the meantime
+                        self._pending.setdefault(key, (client, view, digest))
+                else:
+                    self.logger.warning(f"Failed to publish the Home tab (user: {key[2]}, error: {e.response['error']})")
+            except Exception as e:
+                self.logger.exception(f"Failed to publish the Home tab (user: {key[2]}, error: {e})")
@@ -0,0 +1,48 @@
+import threading
+from typing import Optional
+
+from app.installations import LruCache
+from app.shared_store import SharedStore
+
+
+class IdempotencyStore:
+    """Remembers the writes already started, so that a request delivered twice does not create two Notion pages.
+
+    A record is {"status": "started"} until the page is created, and then {"status": "done", "page_url": ...}.
+    Records are kept in a bounded in-memory LRU cache for ttl_seconds, and in the shared store when
+    several processes serve the same workspaces, so that a retry reaching another process is recognized too.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, max_entries: int = 10000, store: Optional[SharedStore] = None):
+        self.ttl_seconds = ttl_seconds
+        self.cache = LruCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.store = store if store is not None else SharedStore()
+        self._lock = threading.Lock()
+
+    def claim(self, key: str) -> Optional[dict]:
+        """Returns None when the caller is the first to claim key and should do the write, or else the existing record."""
+        with self._lock:
+            record = self.find(key)
+            if record is not None:
+                return record
+            if not self.store.try_lock(f"idempotency:{key}", self.ttl_seconds):
+                # Another process has claimed it but not finished yet
+                return self.store.get(f"idempotency:{key}") or {"status": "started"}
+            record = {"status": "started"}
+            self.cache.put(key, record)
+            return None
+
+    def complete(self, key: str, page_url: str) -> None:
+        record = {"status": "done", "page_url": page_url}
+        self.cache.put(key, record)
+        self.store.put(f"idempotency:{key}", record, ttl_seconds=self.ttl_seconds)
+
+    def find(self, key: str) -> Optional[dict]:
+        record = self.cache.get(key)
+        if record is None or record["status"] != "done":
+            # The write may have been finished by another process
+            stored = self.store.get(f"idempotency:{key}")
+            if stored is not None:
+                self.cache.put(key, stored)
+                record = stored
+        return record
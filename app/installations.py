@@ -0,0 +1,240 @@
+import base64
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from urllib.parse import urlencode, urlparse
+
+import httpx
+from slack_bolt import BoltContext
+from slack_bolt.authorization import AuthorizeResult
+from slack_bolt.authorization.async_authorize import AsyncAuthorize
+from slack_bolt.authorization.authorize import Authorize
+from slack_bolt.context.async_context import AsyncBoltContext
+
+
+class LruCache:
+    """Thread-safe LRU cache whose entries also expire after ttl_seconds."""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] >= self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class CachedAuthorize(Authorize):
+    """Remembers the results of another Authorize per workspace.
+
+    Bolt's InstallationStoreAuthorize reads the installation store and calls auth.test for
+    every request. With this in front of it, only the first request in ttl_seconds does so.
+    """
+
+    def __init__(self, authorize: Authorize, cache: LruCache):
+        super().__init__()
+        self.authorize = authorize
+        self.cache = cache
+
+    def __call__(
+        self,
+        *,
+        context: BoltContext,
+        enterprise_id: Optional[str],
+        team_id: Optional[str],
+        user_id: Optional[str],
+        **kwargs,
+    ) -> Optional[AuthorizeResult]:
+        result = self.cache.get((enterprise_id, team_id))
+        if result is None:
+            result = self.authorize(context=context, enterprise_id=enterprise_id, team_id=team_id, user_id=user_id, **kwargs)
+            if result is not None:
+                self.cache.put((enterprise_id, team_id), result)
+        return result
+
+
+class AsyncCachedAuthorize(AsyncAuthorize):
+    """The asyncio version of CachedAuthorize."""
+
+    def __init__(self, authorize: AsyncAuthorize, cache: LruCache):
+        super().__init__()
+        self.authorize = authorize
+        self.cache = cache
+
+    async def __call__(
+        self,
+        *,
+        context: AsyncBoltContext,
+        enterprise_id: Optional[str],
+        team_id: Optional[str],
+        user_id: Optional[str],
+        **kwargs,
+    ) -> Optional[AuthorizeResult]:
+        result = self.cache.get((enterprise_id, team_id))
+        if result is None:
+            result = await self.authorize(
+                context=context, enterprise_id=enterprise_id, team_id=team_id, user_id=user_id, **kwargs
+            )
+            if result is not None:
+                self.cache.put((enterprise_id, team_id), result)
+        return result
+
+
+class NotionInstallationStore:
+    """SQLite-backed store of the Notion integrations that each Slack workspace connected via OAuth.
+
+    Token lookups go through an LRU cache, so the file is read only when a workspace's
+    token is not in memory yet. Workspaces of an org-wide installation fall back to the
+    installation saved for the whole organization.
+    """
+
+    def __init__(self, path: str, cache: Optional[LruCache] = None):
+        self.cache = cache if cache is not None else LruCache()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS notion_installations (
+                enterprise_id TEXT NOT NULL DEFAULT '',
+                team_id TEXT NOT NULL DEFAULT '',
+                access_token TEXT NOT NULL,
+                bot_id TEXT,
+                workspace_id TEXT,
+                workspace_name TEXT,
+                installed_at REAL NOT NULL,
+                PRIMARY KEY (enterprise_id, team_id)
+            )
+            """)
+        self._lock = threading.Lock()
+
+    def save(self, enterprise_id: Optional[str], team_id: Optional[str], installation: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO notion_installations (enterprise_id, team_id, access_token, bot_id, "
+                "workspace_id, workspace_name, installed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    enterprise_id or "",
+                    team_id or "",
+                    installation["access_token"],
+                    installation.get("bot_id"),
+                    installation.get("workspace_id"),
+                    installation.get("workspace_name"),
+                    time.time(),
+                ),
+            )
+        self.cache.invalidate((enterprise_id, team_id))
+
+    def find_token(self, enterprise_id: Optional[str], team_id: Optional[str]) -> Optional[str]:
+        token = self.cache.get((enterprise_id, team_id))
+        if token is not None:
+            return token
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT access_token FROM notion_installations WHERE enterprise_id = ? AND team_id IN (?, '') "
+                "ORDER BY team_id DESC LIMIT 1",
+                (enterprise_id or "", team_id or ""),
+            ).fetchone()
+        if row is None:
+            # Not cached so that a workspace can use the app right after connecting Notion
+            return None
+        self.cache.put((enterprise_id, team_id), row[0])
+        return row[0]
+
+
+class NotionOAuthFlow:
+    """Connects a Notion public integration to the Slack workspace that just installed this app.
+
+    The state parameter carries the Slack workspace and is signed with the client secret,
+    so the callback doesn't need a state store.
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        redirect_uri: str,
+        installation_store: NotionInstallationStore,
+        state_expiration_seconds: float = 600,
+        base_url: str = "https://api.notion.com",
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.installation_store = installation_store
+        self.state_expiration_seconds = state_expiration_seconds
+        self.base_url = base_url
+
+    @property
+    def redirect_uri_path(self) -> str:
+        return urlparse(self.redirect_uri).path
+
+    def build_authorize_url(self, enterprise_id: Optional[str], team_id: Optional[str]) -> str:
+        expires_at = time.time() + self.state_expiration_seconds
+        state = self._sign({"enterprise_id": enterprise_id, "team_id": team_id, "expires_at": expires_at})
+        query = {
+            "client_id": self.client_id,
+            "response_type": "code",
+            "owner": "user",
+            "redirect_uri": self.redirect_uri,
+            "state": state,
+        }
+        return f"{self.base_url}/v1/oauth/authorize?{urlencode(query)}"
+
+    def handle_callback(self, params: Dict[str, str]) -> Tuple[int, str]:
+        """Completes the flow with the redirect's query parameters. Returns the status code and text to respond with."""
+        workspace = self._verify(params.get("state", ""))
+        if workspace is None or workspace["expires_at"] < time.time():
+            return 400, "The link has expired. Please install this app again."
+        if params.get("code") is None:
+            return 400, f"Connecting Notion was cancelled ({params.get('error', 'unknown error')})."
+
+        response = httpx.post(
+            f"{self.base_url}/v1/oauth/token",
+            auth=(self.client_id, self.client_secret),
+            json={"grant_type": "authorization_code", "code": params["code"], "redirect_uri": self.redirect_uri},
+            timeout=30,
+        )
+        if response.status_code != 200:
+            return 400, f"Failed to connect Notion (error: {response.text})"
+        self.installation_store.save(workspace["enterprise_id"], workspace["team_id"], response.json())
+        return 200, "Notion is now connected! You can close this window and go back to Slack."
+
+    def _sign(self, payload: dict) -> str:
+        body = base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+        return f"{body}.{self._signature(body)}"
+
+    def _verify(self, state: str) -> Optional[dict]:
+        body, _, signature = state.partition(".")
+        if not hmac.compare_digest(signature, self._signature(body)):
+            return None
+        try:
+            return json.loads(base64.urlsafe_b64decode(body.encode("ascii")))
+        except ValueError:
+            return None
+
+    def _signature(self, body: str) -> str:
+        return hmac.new(self.client_secret.encode("utf-8"), body.encode("ascii"), hashlib.sha256).hexdigest()
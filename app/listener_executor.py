@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional
+
+from app.metrics import Metrics
+
+# Bolt runs ack() functions in the listener executor too, when process_before_response is False. They are told apart
+# by the name of the closure that Bolt's ThreadListenerRunner submits (slack_bolt/listener/thread_runner.py, the same
+# from slack-bolt 1.15 to 1.30). It is not a public API, so check it when upgrading slack-bolt: if it is renamed,
+# ack() functions share the lazy listener pool and are counted as lazy listeners.
+_ACK_FUNCTION_NAME = "run_ack_function_asynchronously"
+
+
+class _FunctionStats:
+    def __init__(self):
+        self.count = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.run_seconds_total = 0.0
+        self.run_seconds_max = 0.0
+
+    def record(self, wait_seconds: float, run_seconds: float) -> None:
+        self.count += 1
+        self.wait_seconds_total += wait_seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+        self.run_seconds_total += run_seconds
+        self.run_seconds_max = max(self.run_seconds_max, run_seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+            "run_seconds_total": self.run_seconds_total,
+            "run_seconds_max": self.run_seconds_max,
+        }
+
+
+class LazyListenerExecutor(Executor):
+    """A listener executor for Bolt apps with a fixed number of workers and a bounded queue for lazy listeners.
+
+    ack() functions run on their own small pool so that they are never delayed by lazy listeners.
+    When the lazy listener queue is full:
+    * "wait" policy: lazy listeners keep queuing past max_queue_size until a worker is free
+    * "reject" policy: listeners are expected to check is_overloaded() in ack() and reject the request there
+
+    Bolt submits lazy listeners on the request's thread before it responds to Slack, so submit() never blocks.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 10,
+        max_queue_size: int = 100,
+        overload_policy: str = "reject",
+        ack_workers: int = 5,
+        metrics: Optional[Metrics] = None,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        if overload_policy not in ("reject", "wait"):
+            raise ValueError(f"Unknown overload policy: {overload_policy}")
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.overload_policy = overload_policy
+        self.metrics = metrics
+        self.logger = logger
+        self._lazy_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bolt-lazy-listener")
+        self._ack_executor = ThreadPoolExecutor(max_workers=ack_workers, thread_name_prefix="bolt-ack")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._functions: Dict[str, _FunctionStats] = {}
+        if metrics is not None:
+            metrics.lazy_listeners.add_callback(self._count_lazy_listeners)
+
+    def is_overloaded(self) -> bool:
+        return self._pending >= self.max_queue_size
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        name = getattr(fn, "__name__", repr(fn))
+        if name == _ACK_FUNCTION_NAME:
+            return self._ack_executor.submit(fn, *args, **kwargs)
+
+        if self.overload_policy == "wait" and self.is_overloaded():
+            self.logger.warning(f"The lazy listener queue is full. {name} waits behind {self._pending} lazy listeners")
+        submitted_at = time.monotonic()
+        with self._lock:
+            self._pending += 1
+
+        def run():
+            started_at = time.monotonic()
+            with self._lock:
+                self._pending -= 1
+                self._running += 1
+            status = "ok"
+            try:
+                return fn(*args, **kwargs)
+            except BaseException:
+                status = "error"
+                raise
+            finally:
+                finished_at = time.monotonic()
+                with self._lock:
+                    self._running -= 1
+                    stats = self._functions.setdefault(name, _FunctionStats())
+                    stats.record(wait_seconds=started_at - submitted_at, run_seconds=finished_at - started_at)
+                if self.metrics is not None:
+                    self.metrics.lazy_listener_wait_seconds.observe(started_at - submitted_at, function=name)
+                    self.metrics.lazy_listener_seconds.observe(finished_at - started_at, function=name, status=status)
+
+        return self._lazy_executor.submit(run)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queue_depth": self._pending,
+                "running": self._running,
+                "functions": {name: s.to_dict() for name, s in self._functions.items()},
+            }
+
+    def _count_lazy_listeners(self) -> Dict[tuple, float]:
+        stats = self.stats()
+        return {("waiting",): stats["queue_depth"], ("running",): stats["running"]}
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._lazy_executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        self._ack_executor.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,342 @@
+import functools
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Iterator
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """A thread-safe histogram that renders in the Prometheus text exposition format."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # label values -> (cumulative bucket counts, sum, count)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (bucket_counts, total, count) in series:
+            labels = list(zip(self.label_names, key))
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', str(bound))])} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """A gauge or counter whose values are read from callbacks when rendered.
+
+    Each callback returns the values keyed by their label values, and the values of all the callbacks are added up.
+    """
+
+    def __init__(self, name: str, documentation: str, metric_type: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self._callbacks: List[Callable[[], Dict[Tuple[str, ...], float]]] = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            callbacks = list(self._callbacks)
+        values: Dict[Tuple[str, ...], float] = {}
+        for callback in callbacks:
+            for key, value in callback().items():
+                values[key] = values.get(key, 0) + value
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(list(zip(self.label_names, key)))} {value}")
+        return lines
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    """The latency histograms of this app, and the gauges and counters read from its components."""
+
+    def __init__(self):
+        self.slack_ack_seconds = Histogram(
+            "slack_ack_seconds",
+            "Time from receiving a Slack request until ack() is done",
+            ("listener",),
+        )
+        self.lazy_listener_wait_seconds = Histogram(
+            "lazy_listener_wait_seconds",
+            "Time lazy listeners wait for a free worker",
+            ("function",),
+        )
+        self.lazy_listener_seconds = Histogram(
+            "lazy_listener_seconds",
+            "Time lazy listeners take to run",
+            ("function", "status"),
+        )
+        self.notion_api_seconds = Histogram(
+            "notion_api_seconds",
+            "Notion API call latency",
+            ("method", "endpoint", "status"),
+        )
+        self.slack_api_seconds = Histogram(
+            "slack_api_seconds",
+            "Slack Web API call latency",
+            ("method", "status"),
+        )
+        self.lazy_listeners = CallbackMetric(
+            "lazy_listeners",
+            "Lazy listeners waiting for a free worker or running",
+            "gauge",
+            ("state",),
+        )
+        self.notion_client_lookups = CallbackMetric(
+            "notion_client_lookups_total",
+            "Lookups of the pooled Notion API client per token, by whether it already existed",
+            "counter",
+            ("result",),
+        )
+        self.notion_connections = CallbackMetric(
+            "notion_connections_total",
+            "Notion API requests by whether they opened a new connection or reused a kept-alive one",
+            "counter",
+            ("connection",),
+        )
+
+    def render(self) -> str:
+        lines = []
+        for histogram in (
+            self.slack_ack_seconds,
+            self.lazy_listener_wait_seconds,
+            self.lazy_listener_seconds,
+            self.notion_api_seconds,
+            self.slack_api_seconds,
+        ):
+            lines.extend(histogram.render())
+        for metric in (self.lazy_listeners, self.notion_client_lookups, self.notion_connections):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(
+    metrics: Metrics,
+    port: int,
+    host: str = "0.0.0.0",
+    logger: logging.Logger = logging.getLogger(__name__),
+) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
+
+
+_NOTION_ID_PATTERN = re.compile(r"[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}")
+
+
+def notion_endpoint(path: str) -> str:
+    """Replaces the IDs in a Notion API path so that calls are grouped by endpoint: /v1/databases/{id}/query"""
+    return _NOTION_ID_PATTERN.sub("{id}", path)
+
+
+def listener_name(body: dict) -> str:
+    """Identifies the listener that a Slack request is dispatched to, such as view_submission:send-to-notion-database."""
+    request_type = body.get("type")
+    if request_type is None and "command" in body:
+        return f"command:{body['command']}"
+    if request_type == "event_callback":
+        return f"event:{body.get('event', {}).get('type')}"
+    if request_type == "view_submission" or request_type == "view_closed":
+        return f"{request_type}:{body.get('view', {}).get('callback_id')}"
+    if request_type == "block_actions":
+        actions = body.get("actions") or [{}]
+        return f"{request_type}:{actions[0].get('action_id')}"
+    if request_type == "block_suggestion":
+        return f"{request_type}:{body.get('action_id')}"
+    if request_type in ("shortcut", "message_action"):
+        return f"{request_type}:{body.get('callback_id')}"
+    return str(request_type)
+
+
+def _slack_api_status(e: Exception) -> str:
+    if isinstance(e, SlackApiError):
+        return str(e.response.get("error", "error"))
+    return type(e).__name__
+
+
+class InstrumentedWebClient(WebClient):
+    """WebClient that records the latency of every Slack API call."""
+
+    def __init__(self, *args, metrics: Optional[Metrics] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def __deepcopy__(self, memo):
+        # Bolt deep-copies the context's client for lazy listeners; the copy keeps recording to the same metrics
+        return instrument_web_client(self, self.metrics)
+
+    def api_call(self, api_method: str, **kwargs):
+        if self.metrics is None:
+            return super().api_call(api_method, **kwargs)
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return super().api_call(api_method, **kwargs)
+        except Exception as e:
+            status = _slack_api_status(e)
+            raise
+        finally:
+            self.metrics.slack_api_seconds.observe(time.perf_counter() - started_at, method=api_method, status=status)
+
+
+class AsyncInstrumentedWebClient(AsyncWebClient):
+    """The asyncio version of InstrumentedWebClient."""
+
+    def __init__(self, *args, metrics: Optional[Metrics] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def __deepcopy__(self, memo):
+        # Bolt deep-copies the context's client for lazy listeners; the copy keeps recording to the same metrics
+        return instrument_async_web_client(self, self.metrics)
+
+    async def api_call(self, api_method: str, **kwargs):
+        if self.metrics is None:
+            return await super().api_call(api_method, **kwargs)
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await super().api_call(api_method, **kwargs)
+        except Exception as e:
+            status = _slack_api_status(e)
+            raise
+        finally:
+            self.metrics.slack_api_seconds.observe(time.perf_counter() - started_at, method=api_method, status=status)
+
+
+def instrument_web_client(client: WebClient, metrics: Optional[Metrics]) -> InstrumentedWebClient:
+    """Copies a WebClient, such as the one Bolt builds for each request, into an InstrumentedWebClient."""
+    instrumented = InstrumentedWebClient(
+        token=client.token,
+        base_url=client.base_url,
+        timeout=client.timeout,
+        ssl=client.ssl,
+        proxy=client.proxy,
+        headers=client.headers,
+        logger=client.logger,
+        retry_handlers=client.retry_handlers,
+        metrics=metrics,
+    )
+    instrumented.default_params = client.default_params
+    return instrumented
+
+
+def instrument_async_web_client(client: AsyncWebClient, metrics: Optional[Metrics]) -> AsyncInstrumentedWebClient:
+    instrumented = AsyncInstrumentedWebClient(
+        token=client.token,
+        base_url=client.base_url,
+        timeout=client.timeout,
+        ssl=client.ssl,
+        proxy=client.proxy,
+        session=client.session,
+        trust_env_in_session=client.trust_env_in_session,
+        headers=client.headers,
+        logger=client.logger,
+        retry_handlers=client.retry_handlers,
+        metrics=metrics,
+    )
+    instrumented.default_params = client.default_params
+    return instrumented
+
+
+def time_async_lazy_listener(fn: Callable, metrics: Optional[Metrics]) -> Callable:
+    """Records lazy_listener_seconds for an async lazy listener, as asyncio mode has no listener executor.
+
+    Bolt starts async lazy listeners as tasks right away, so they have no lazy_listener_wait_seconds.
+    """
+    if metrics is None:
+        return fn
+
+    # functools.wraps keeps the signature that Bolt reads to pick the listener's arguments
+    @functools.wraps(fn)
+    async def timed(*args, **kwargs):
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await fn(*args, **kwargs)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            metrics.lazy_listener_seconds.observe(time.perf_counter() - started_at, function=fn.__name__, status=status)
+
+    return timed
+
+
+def summarize_request(body: dict, context: dict) -> dict:
+    """A structured log record of a Slack request. The verification token is left out."""
+    return {
+        "listener": listener_name(body),
+        "enterprise_id": context.get("enterprise_id"),
+        "team_id": context.get("team_id"),
+        "user_id": context.get("user_id"),
+        "body": {k: v for k, v in body.items() if k != "token"},
+    }
@@ -0,0 +1,206 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Set
+
+from app.notion_database_directory import NotionDatabaseDirectory
+from app.notion_option_index import build_option_indexes
+from app.notion_page_index import NotionPageTitleIndex
+from app.shared_store import SharedStore
+from app.slack_notion_user_index import SlackNotionUserIndex
+
+
+class NotionSchemaCache:
+    """LRU cache of retrieved Notion databases, the modal blocks built from them and their large option sets' indexes.
+
+    An entry is reused as long as the database directory reports the same last_edited_time.
+    When the directory does not know the database, the entry is reused until its TTL expires.
+    Entries missing in memory are looked up in the shared store, which the other processes write to.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 500,
+        ttl_seconds: float = 300,
+        store: Optional[SharedStore] = None,
+        store_key: str = "schemas",
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.store = store if store is not None else SharedStore()
+        self.store_key = store_key
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, database_id: str, last_edited_time: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(database_id)
+        if entry is None:
+            stored = self.store.get(f"{self.store_key}:{database_id}")
+            if stored is None:
+                return None
+            entry = self._add(stored["database"], stored["blocks"], stored["cached_at"])
+        with self._lock:
+            if last_edited_time is not None:
+                fresh = entry["database"].get("last_edited_time") == last_edited_time
+            else:
+                fresh = time.time() - entry["cached_at"] < self.ttl_seconds
+            if not fresh:
+                self._entries.pop(database_id, None)
+                return None
+            if database_id in self._entries:
+                self._entries.move_to_end(database_id)
+            return entry
+
+    def put(self, database: dict, blocks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        entry = self._add(database, blocks, time.time())
+        self.store.put(
+            f"{self.store_key}:{database['id']}",
+            {"database": database, "blocks": blocks, "cached_at": entry["cached_at"]},
+        )
+        return entry
+
+    def _add(self, database: dict, blocks: List[Dict[str, Any]], cached_at: float) -> Dict[str, Any]:
+        entry = {
+            "database": database,
+            "blocks": blocks,
+            "option_indexes": build_option_indexes(database),
+            "cached_at": cached_at,
+        }
+        with self._lock:
+            self._entries[database["id"]] = entry
+            self._entries.move_to_end(database["id"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+class NotionCaches:
+    """All the cached Notion data for a single Notion token.
+
+    Everything is also written to the shared store under the given namespace.
+    """
+
+    def __init__(
+        self,
+        database_directory_ttl_seconds: float = 60,
+        schema_cache_ttl_seconds: float = 300,
+        store: Optional[SharedStore] = None,
+        namespace: str = "default",
+    ):
+        self.store = store if store is not None else SharedStore()
+        self.namespace = namespace
+        self.database_directory = NotionDatabaseDirectory(
+            ttl_seconds=database_directory_ttl_seconds,
+            store=self.store,
+            store_key=f"{namespace}:database_directory",
+        )
+        self.schemas = NotionSchemaCache(
+            ttl_seconds=schema_cache_ttl_seconds,
+            store=self.store,
+            store_key=f"{namespace}:schemas",
+        )
+        self.page_index_ttl_seconds = database_directory_ttl_seconds
+        self._page_indexes: Dict[str, NotionPageTitleIndex] = {}
+        self._user_indexes: Dict[str, SlackNotionUserIndex] = {}
+        self._user_index_syncs_started: Set[str] = set()
+        self._prefetching: Set[str] = set()
+        self._background_sync_started = False
+        self._lock = threading.Lock()
+
+    def page_index(self, database_id: str) -> NotionPageTitleIndex:
+        """Returns the page title index of a relation property's target database."""
+        with self._lock:
+            index = self._page_indexes.get(database_id)
+            if index is None:
+                index = NotionPageTitleIndex(
+                    ttl_seconds=self.page_index_ttl_seconds,
+                    store=self.store,
+                    store_key=f"{self.namespace}:page_index:{database_id}",
+                )
+                self._page_indexes[database_id] = index
+            return index
+
+    def user_index(self, enterprise_id: Optional[str], team_id: Optional[str]) -> SlackNotionUserIndex:
+        """Returns the index that maps a Slack workspace's users to the users of this Notion workspace.
+
+        Several Slack workspaces can share a Notion token, and each of them has users of its own.
+        """
+        workspace = f"{enterprise_id or ''}:{team_id or ''}"
+        with self._lock:
+            index = self._user_indexes.get(workspace)
+            if index is None:
+                index = SlackNotionUserIndex(store=self.store, store_key=f"{self.namespace}:users:{workspace}")
+                self._user_indexes[workspace] = index
+            return index
+
+    def load_snapshots(self) -> None:
+        """Loads the database directory from the shared store.
+
+        Forms and page title indexes don't need this because they are loaded from the store on first use.
+        """
+        self.database_directory.load_snapshot()
+
+    def find_database_form(self, database_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the cached database and its modal blocks if they are still fresh, without calling Notion."""
+        known = self.database_directory.get(database_id)
+        return self.schemas.get(database_id, known["last_edited_time"] if known is not None else None)
+
+    def begin_background_sync(self) -> bool:
+        """Returns True only for the first caller, which is supposed to start the background syncs for this token."""
+        with self._lock:
+            if self._background_sync_started:
+                return False
+            self._background_sync_started = True
+            return True
+
+    def begin_user_index_sync(self, enterprise_id: Optional[str], team_id: Optional[str]) -> bool:
+        """Returns True only for the first caller, which is supposed to start the Slack workspace's user index sync."""
+        workspace = f"{enterprise_id or ''}:{team_id or ''}"
+        with self._lock:
+            if workspace in self._user_index_syncs_started:
+                return False
+            self._user_index_syncs_started.add(workspace)
+            return True
+
+    def begin_prefetch(self, database_id: str) -> bool:
+        with self._lock:
+            if database_id in self._prefetching:
+                return False
+            self._prefetching.add(database_id)
+            return True
+
+    def end_prefetch(self, database_id: str) -> None:
+        with self._lock:
+            self._prefetching.discard(database_id)
+
+
+class NotionCachesRegistry:
+    """Process-wide NotionCaches instances keyed by Notion token."""
+
+    def __init__(
+        self,
+        database_directory_ttl_seconds: float = 60,
+        schema_cache_ttl_seconds: float = 300,
+        store: Optional[SharedStore] = None,
+    ):
+        self.database_directory_ttl_seconds = database_directory_ttl_seconds
+        self.schema_cache_ttl_seconds = schema_cache_ttl_seconds
+        self.store = store if store is not None else SharedStore()
+        self._caches: Dict[str, NotionCaches] = {}
+        self._lock = threading.Lock()
+
+    def get(self, notion_token: str) -> NotionCaches:
+        with self._lock:
+            caches = self._caches.get(notion_token)
+            if caches is None:
+                caches = NotionCaches(
+                    database_directory_ttl_seconds=self.database_directory_ttl_seconds,
+                    schema_cache_ttl_seconds=self.schema_cache_ttl_seconds,
+                    store=self.store,
+                    # the token itself never goes to the shared store
+                    namespace=hashlib.sha256(notion_token.encode("utf-8")).hexdigest()[:16],
+                )
+                self._caches[notion_token] = caches
+            return caches
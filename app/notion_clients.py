@@ -0,0 +1,193 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Iterator, Optional, Union
+
+import httpx
+from notion_client import Client, AsyncClient
+
+from app.metrics import Metrics, notion_endpoint
+
+# The time.monotonic() by which the Notion API calls made in this thread or task have to finish
+_call_deadline: ContextVar[Optional[float]] = ContextVar("notion_call_deadline", default=None)
+
+
+@contextmanager
+def notion_call_deadline(deadline: Optional[float]) -> Iterator[None]:
+    """Caps the timeout of the Notion API calls made inside, such as the ones answering Slack within 3 seconds."""
+    token = _call_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _call_deadline.reset(token)
+
+
+class NotionClientStats:
+    """Counts how often Notion API calls reuse clients and keep-alive connections."""
+
+    def __init__(self):
+        self.client_hits = 0
+        self.client_misses = 0
+        self.requests = 0
+        self.new_connections = 0
+        self._lock = threading.Lock()
+
+    def count_client(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.client_hits += 1
+            else:
+                self.client_misses += 1
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def count_new_connection(self) -> None:
+        with self._lock:
+            self.new_connections += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "client_hits": self.client_hits,
+                "client_misses": self.client_misses,
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(self.requests - self.new_connections, 0),
+            }
+
+
+class _BaseNotionClientRegistry:
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry_seconds: float = 60,
+        timeout_seconds: float = 30,
+        http2: bool = False,
+        base_url: Optional[str] = None,
+        metrics: Optional[Metrics] = None,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry_seconds,
+        )
+        self.timeout_seconds = timeout_seconds
+        # HTTP/2 requires the optional h2 package: pip install "httpx[http2]"
+        self.http2 = http2
+        # Only changed to run the app against a stand-in for the Notion API such as the one in benchmarks/
+        self.base_url = base_url
+        self.metrics = metrics
+        self.logger = logger
+        self.stats = NotionClientStats()
+        self._clients: Dict[str, Union[Client, AsyncClient]] = {}
+        self._lock = threading.Lock()
+        if metrics is not None:
+            metrics.notion_client_lookups.add_callback(self._count_client_lookups)
+            metrics.notion_connections.add_callback(self._count_connections)
+
+    def _count_client_lookups(self) -> Dict[tuple, float]:
+        stats = self.stats.to_dict()
+        return {("hit",): stats["client_hits"], ("miss",): stats["client_misses"]}
+
+    def _count_connections(self) -> Dict[tuple, float]:
+        stats = self.stats.to_dict()
+        return {("new",): stats["new_connections"], ("reused",): stats["reused_connections"]}
+
+    def get(self, notion_token: str):
+        with self._lock:
+            notion = self._clients.get(notion_token)
+            self.stats.count_client(hit=notion is not None)
+            if notion is None:
+                notion = self._build_client(notion_token)
+                self._clients[notion_token] = notion
+            return notion
+
+    def _build_client(self, notion_token: str):
+        raise NotImplementedError()
+
+    def _client_options(self) -> Dict[str, Any]:
+        options = {"timeout_ms": int(self.timeout_seconds * 1000)}
+        if self.base_url is not None:
+            options["base_url"] = self.base_url
+        return options
+
+    def _on_trace(self, event_name: str, info: dict) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            self.stats.count_new_connection()
+            self.logger.debug(f"Opened a new Notion API connection (stats: {self.stats.to_dict()})")
+
+    def _on_request(self, request: httpx.Request) -> None:
+        self.stats.count_request()
+        request.extensions["started_at"] = time.perf_counter()
+        deadline = _call_deadline.get()
+        if deadline is not None:
+            remaining_seconds = max(deadline - time.monotonic(), 0.001)
+            if remaining_seconds < self.timeout_seconds:
+                request.extensions["timeout"] = httpx.Timeout(remaining_seconds).as_dict()
+
+    def _on_response(self, response: httpx.Response) -> None:
+        started_at = response.request.extensions.get("started_at")
+        if self.metrics is not None and started_at is not None:
+            self.metrics.notion_api_seconds.observe(
+                time.perf_counter() - started_at,
+                method=response.request.method,
+                endpoint=notion_endpoint(response.request.url.path),
+                status=str(response.status_code),
+            )
+
+
+class NotionClientRegistry(_BaseNotionClientRegistry):
+    """Long-lived Notion clients keyed by token, sharing keep-alive connection pools across requests."""
+
+    def get(self, notion_token: str) -> Client:
+        return super().get(notion_token)
+
+    def _build_client(self, notion_token: str) -> Client:
+        def on_request(request: httpx.Request):
+            self._on_request(request)
+            request.extensions["trace"] = self._on_trace
+
+        event_hooks = {"request": [on_request], "response": [self._on_response]}
+        http_client = httpx.Client(limits=self.limits, http2=self.http2, event_hooks=event_hooks)
+        return Client(auth=notion_token, client=http_client, **self._client_options())
+
+    def close(self) -> None:
+        with self._lock:
+            for notion in self._clients.values():
+                notion.close()
+            self._clients.clear()
+
+
+class AsyncNotionClientRegistry(_BaseNotionClientRegistry):
+    """The asyncio version of NotionClientRegistry."""
+
+    def get(self, notion_token: str) -> AsyncClient:
+        return super().get(notion_token)
+
+    def _build_client(self, notion_token: str) -> AsyncClient:
+        async def on_trace(event_name: str, info: dict):
+            self._on_trace(event_name, info)
+
+        async def on_request(request: httpx.Request):
+            self._on_request(request)
+            request.extensions["trace"] = on_trace
+
+        async def on_response(response: httpx.Response):
+            self._on_response(response)
+
+        event_hooks = {"request": [on_request], "response": [on_response]}
+        http_client = httpx.AsyncClient(limits=self.limits, http2=self.http2, event_hooks=event_hooks)
+        return AsyncClient(auth=notion_token, client=http_client, **self._client_options())
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for notion in clients:
+            await notion.aclose()
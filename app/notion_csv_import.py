@@ -0,0 +1,241 @@
+import csv
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Iterator, List, Optional
+
+import httpx
+from notion_client import Client
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import ConnectionErrorRetryHandler, RateLimitErrorRetryHandler
+
+from app.idempotency import IdempotencyStore
+from app.notion_caches import NotionCachesRegistry
+from app.notion_clients import NotionClientRegistry
+from app.notion_ops import find_notion_database_form, find_csv_title_column, csv_row_to_state_values, send_to_notion
+from app.rate_limiter import TokenBucket, TokenBucketRegistry, call_with_retries
+from app.slack_views import validate_send_to_notion_submission
+
+_LINE_PATTERN = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)")
+
+
+def iter_csv_lines(chunks: Iterable[str]) -> Iterator[str]:
+    """Splits streamed text into lines, keeping line endings so that csv can parse quoted multi-line values."""
+    pending = ""
+    first = True
+    for chunk in chunks:
+        if first:
+            chunk = chunk.lstrip("\ufeff")
+            first = False
+        pending += chunk
+        consumed = 0
+        for match in _LINE_PATTERN.finditer(pending):
+            # A trailing "\r" may be the first half of "\r\n" split across chunks
+            if match.end() == len(pending) and pending.endswith("\r"):
+                break
+            consumed = match.end()
+            yield match.group()
+        pending = pending[consumed:]
+    if len(pending) > 0:
+        yield pending
+
+
+class _ImportProgress:
+    def __init__(self):
+        self.created = 0
+        self.failures: List[str] = []
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def succeed(self) -> None:
+        with self._lock:
+            self.created += 1
+
+    def fail(self, row_number: int, reason: str) -> None:
+        with self._lock:
+            self.failed += 1
+            self.failures.append(f"Row {row_number}: {reason}")
+
+    def drain_failures(self) -> List[str]:
+        with self._lock:
+            failures, self.failures = self.failures, []
+            return failures
+
+
+class NotionCsvImporter:
+    """Streams a CSV file uploaded to Slack into a Notion database.
+
+    Rows are read one by one from the download stream and converted with the same
+    property conversion as the modal. Pages are created by a bounded thread pool that
+    shares the per-token rate limiters with the write queue, so that memory use stays
+    flat and Notion's rate limits are respected regardless of the file size.
+    """
+
+    def __init__(
+        self,
+        notion_clients: NotionClientRegistry,
+        notion_caches: NotionCachesRegistry,
+        rate_limiters: TokenBucketRegistry,
+        concurrency: int = 3,
+        max_attempts: int = 5,
+        progress_interval_seconds: float = 5,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        self.notion_clients = notion_clients
+        self.notion_caches = notion_caches
+        self.rate_limiters = rate_limiters
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.progress_interval_seconds = progress_interval_seconds
+        self.idempotency_store = idempotency_store if idempotency_store is not None else IdempotencyStore()
+        self.logger = logger
+
+    def start(
+        self,
+        *,
+        notion_token: str,
+        bot_token: str,
+        database_id: str,
+        file: dict,
+        channel_id: str,
+        thread_ts: str,
+        idempotency_key: Optional[str] = None,
+    ) -> Optional[threading.Thread]:
+        """Starts importing the file in a thread. Returns None when an import with the same idempotency key has started."""
+        if idempotency_key is not None and self.idempotency_store.claim(idempotency_key) is not None:
+            self.logger.info(f"Skipped a CSV import that has already started (file: {file['id']})")
+            return None
+
+        def run():
+            try:
+                self.run(
+                    notion_token=notion_token,
+                    bot_token=bot_token,
+                    database_id=database_id,
+                    file=file,
+                    channel_id=channel_id,
+                    thread_ts=thread_ts,
+                )
+            except Exception as e:
+                self.logger.exception(e)
+
+        thread = threading.Thread(target=run, name=f"notion-csv-import-{file['id']}", daemon=True)
+        thread.start()
+        return thread
+
+    def run(
+        self,
+        *,
+        notion_token: str,
+        bot_token: str,
+        database_id: str,
+        file: dict,
+        channel_id: str,
+        thread_ts: str,
+    ) -> None:
+        # A file with many bad rows posts many failure messages, which may be rate-limited by Slack
+        client = WebClient(
+            token=bot_token,
+            retry_handlers=[ConnectionErrorRetryHandler(), RateLimitErrorRetryHandler(max_retry_count=5)],
+        )
+        file_name = file.get("name", "the CSV file")
+        notion = self.notion_clients.get(notion_token)
+        try:
+            database = find_notion_database_form(notion, self.notion_caches.get(notion_token), database_id)["database"]
+        except Exception as e:
+            self.logger.exception(e)
+            client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=thread_ts,
+                text=f":x: Failed to load the Notion database to import {file_name} into (error: {e})",
+            )
+            return
+
+        progress_message = client.chat_postMessage(
+            channel=channel_id,
+            thread_ts=thread_ts,
+            text=f":hourglass: Importing {file_name} into Notion ...",
+        )
+        progress = _ImportProgress()
+        limiter = self.rate_limiters.get(notion_token)
+        # Bounds the number of rows held in memory while waiting for Notion
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        reported_at = time.monotonic()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="notion-csv-import") as executor:
+            try:
+                headers = {"Authorization": f"Bearer {bot_token}"}
+                with httpx.stream("GET", file["url_private_download"], headers=headers, follow_redirects=True) as response:
+                    response.raise_for_status()
+                    reader = csv.DictReader(iter_csv_lines(response.iter_text()))
+                    if find_csv_title_column(database, reader.fieldnames or []) is None:
+                        # Every row would become an untitled page
+                        title = next(n for n, p in database["properties"].items() if p["type"] == "title")
+                        raise ValueError(f"the header has no {title} column, which is the database's title property")
+                    # The header is the first line
+                    for row_number, row in enumerate(reader, start=2):
+                        state_values, errors = csv_row_to_state_values(database, row)
+                        errors.extend(validate_send_to_notion_submission(state_values).values())
+                        if len(errors) > 0:
+                            progress.fail(row_number, ", ".join(errors))
+                        else:
+                            slots.acquire()
+                            future = executor.submit(self._create_page, notion, limiter, database_id, state_values)
+                            future.add_done_callback(self._build_done_callback(progress, slots, row_number))
+
+                        if time.monotonic() - reported_at >= self.progress_interval_seconds:
+                            self._report(client, channel_id, thread_ts, progress_message["ts"], file_name, progress)
+                            reported_at = time.monotonic()
+            except Exception as e:
+                self.logger.exception(e)
+                error = e
+
+        self._report(client, channel_id, thread_ts, progress_message["ts"], file_name, progress, done=True, error=error)
+
+    def _create_page(self, notion: Client, limiter: TokenBucket, database_id: str, state_values: dict) -> dict:
+        return call_with_retries(lambda: send_to_notion(notion, database_id, state_values), limiter, self.max_attempts)
+
+    @staticmethod
+    def _build_done_callback(progress: _ImportProgress, slots: threading.BoundedSemaphore, row_number: int):
+        def done(future: Future):
+            try:
+                future.result()
+                progress.succeed()
+            except Exception as e:
+                progress.fail(row_number, str(e))
+            finally:
+                slots.release()
+
+        return done
+
+    @staticmethod
+    def _report(
+        client: WebClient,
+        channel_id: str,
+        thread_ts: str,
+        progress_message_ts: str,
+        file_name: str,
+        progress: _ImportProgress,
+        done: bool = False,
+        error: Optional[Exception] = None,
+    ) -> None:
+        failures = progress.drain_failures()
+        # Posting the failures in chunks keeps each message small
+        for i in range(0, len(failures), 20):
+            client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=thread_ts,
+                text=":warning: Failed to import the following rows:\n" + "\n".join(failures[i : i + 20]),
+            )
+        counts = f"{progress.created} rows created, {progress.failed} rows failed"
+        if error is not None:
+            text = f":x: Importing {file_name} stopped because of an error (error: {error}). {counts}"
+        elif done:
+            text = f":white_check_mark: Finished importing {file_name}: {counts}"
+        else:
+            text = f":hourglass: Importing {file_name} into Notion ... {counts} so far"
+        client.chat_update(channel=channel_id, ts=progress_message_ts, text=text)
@@ -0,0 +1,166 @@
+import threading
+import time
+from typing import List, Dict, Any, Optional, Iterable
+
+from app.shared_store import SharedStore
+
+
+def database_title(database: dict) -> str:
+    return "".join(t.get("plain_text", "") for t in database.get("title", [])) or "Untitled"
+
+
+class NotionDatabaseDirectory:
+    """In-memory index of the Notion databases that an integration can access.
+
+    The directory itself does not talk to Notion. The functions in app.notion_ops
+    fill it with full and incremental syncs, and the options handler searches it locally.
+    When a shared store is given, each sync is published there, so that the other processes
+    of this app pick it up instead of running the same sync, and a restarted process can
+    serve searches right away while it revalidates the loaded snapshot.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 60,
+        full_sync_interval_seconds: float = 3600,
+        store: Optional[SharedStore] = None,
+        store_key: str = "database_directory",
+        refresh_lease_seconds: float = 600,
+    ):
+        self.ttl_seconds = ttl_seconds
+        # Longer than the slowest full sync, so that another process never starts the same sync while it runs.
+        # The lock is released as soon as the sync ends, so this only matters when a process stops in the middle.
+        self.refresh_lease_seconds = refresh_lease_seconds
+        self.full_sync_interval_seconds = full_sync_interval_seconds
+        self.store = store if store is not None else SharedStore()
+        self.store_key = store_key
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._synced_at: Optional[float] = None
+        self._fully_synced_at: Optional[float] = None
+        # the newest last_edited_time seen so far; incremental syncs stop when they reach it
+        self._watermark: Optional[str] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._fully_synced_at is not None
+
+    @property
+    def watermark(self) -> Optional[str]:
+        return self._watermark
+
+    def is_stale(self) -> bool:
+        return self._synced_at is None or time.time() - self._synced_at >= self.ttl_seconds
+
+    def needs_full_sync(self) -> bool:
+        return self._fully_synced_at is None or time.time() - self._fully_synced_at >= self.full_sync_interval_seconds
+
+    def begin_refresh(self) -> bool:
+        """Claims the right to run a refresh. Returns False if another refresh is running or the data is fresh."""
+        with self._lock:
+            if self._refreshing or not self.is_stale():
+                return False
+            self._load_snapshot()
+            if not self.is_stale() or not self.store.try_lock(self.store_key, self.refresh_lease_seconds):
+                return False
+            self._refreshing = True
+            return True
+
+    def end_refresh(self) -> None:
+        with self._lock:
+            self._refreshing = False
+        self.store.release(self.store_key)
+
+    def replace_all(self, databases: Iterable[dict]) -> None:
+        entries = {}
+        for database in databases:
+            entry = self.to_entry(database)
+            entries[entry["id"]] = entry
+        now = time.time()
+        with self._lock:
+            self._entries = entries
+            self._watermark = max((e["last_edited_time"] for e in entries.values()), default=None)
+            self._synced_at = now
+            self._fully_synced_at = now
+        self._save_snapshot()
+
+    def upsert(self, databases: Iterable[dict]) -> None:
+        entries = [self.to_entry(d) for d in databases]
+        with self._lock:
+            for entry in entries:
+                self._entries[entry["id"]] = entry
+                if self._watermark is None or entry["last_edited_time"] > self._watermark:
+                    self._watermark = entry["last_edited_time"]
+            self._synced_at = time.time()
+        self._save_snapshot()
+
+    def get(self, database_id: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(database_id)
+
+    def search(self, query: Optional[str], limit: int = 100) -> List[Dict[str, Any]]:
+        return rank_entries(list(self._entries.values()), query, limit)
+
+    def load_snapshot(self) -> None:
+        with self._lock:
+            self._load_snapshot()
+
+    def _load_snapshot(self) -> None:
+        snapshot = self.store.get(self.store_key)
+        if snapshot is None or (self._synced_at is not None and snapshot["synced_at"] <= self._synced_at):
+            return
+        self._entries = {e["id"]: e for e in snapshot["entries"]}
+        self._watermark = snapshot["watermark"]
+        self._synced_at = snapshot["synced_at"]
+        self._fully_synced_at = snapshot["fully_synced_at"]
+
+    def _save_snapshot(self) -> None:
+        with self._lock:
+            snapshot = {
+                "entries": list(self._entries.values()),
+                "watermark": self._watermark,
+                "synced_at": self._synced_at,
+                "fully_synced_at": self._fully_synced_at,
+            }
+        # Kept without expiration: even an old snapshot is better than nothing while it's revalidated
+        self.store.put(self.store_key, snapshot)
+
+    @staticmethod
+    def to_entry(database: dict) -> Dict[str, Any]:
+        title = database_title(database)
+        return {
+            "id": database["id"],
+            "title": title,
+            "normalized_title": title.lower(),
+            "last_edited_time": database.get("last_edited_time", ""),
+        }
+
+
+def rank_entries(entries: List[Dict[str, Any]], query: Optional[str], limit: int = 100) -> List[Dict[str, Any]]:
+    """Ranks exact title matches first, then prefix, word prefix and substring matches.
+
+    Without a query, the most recently edited ones come first.
+    """
+    keyword = (query or "").strip().lower()
+    if len(keyword) == 0:
+        return sorted(entries, key=lambda e: e["last_edited_time"], reverse=True)[:limit]
+
+    ranked = []
+    for entry in entries:
+        rank = _rank(entry["normalized_title"], keyword)
+        if rank is not None:
+            ranked.append((rank, entry["normalized_title"], entry))
+    ranked.sort(key=lambda r: (r[0], r[1]))
+    return [r[2] for r in ranked[:limit]]
+
+
+def _rank(title: str, keyword: str) -> Optional[int]:
+    if title == keyword:
+        return 0
+    if title.startswith(keyword):
+        return 1
+    if any(word.startswith(keyword) for word in title.split()):
+        return 2
+    if keyword in title:
+        return 3
+    return None
@@ -1,39 +1,310 @@
-from typing import List, Dict, Any
+import json
+import logging
+import re
+import threading
+import time
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 from notion_client import Client
+from notion_client.errors import RequestTimeoutError
+from slack_sdk import WebClient
+
+from app.notion_caches import NotionCaches
+from app.notion_clients import notion_call_deadline
+from app.notion_database_directory import NotionDatabaseDirectory, rank_entries
+from app.notion_option_index import MAX_STATIC_SELECT_OPTIONS
+from app.notion_page_index import NotionPageTitleIndex
+from app.rate_limiter import TokenBucket
+from app.slack_notion_user_index import SlackNotionUserIndex
 
 
 def find_notion_database(notion: Client, database_id: str) -> dict:
     return notion.databases.retrieve(database_id=database_id)
 
 
-def build_notion_database_options(notion: Client, payload: dict) -> List[Dict[str, Any]]:
+def find_notion_database_form(notion: Client, caches: NotionCaches, database_id: str) -> Dict[str, Any]:
+    cached = caches.find_database_form(database_id)
+    if cached is not None:
+        return cached
+    database = find_notion_database(notion, database_id)
+    return caches.schemas.put(database, build_input_blocks(database))
+
+
+def prefetch_notion_database_forms(
+    notion: Client,
+    caches: NotionCaches,
+    database_ids: List[str],
+    rate_limiter: Optional[TokenBucket],
+    logger: logging.Logger,
+) -> None:
+    for database_id in database_ids:
+        if caches.find_database_form(database_id) is not None or not caches.begin_prefetch(database_id):
+            continue
+        # Prefetching is best-effort, so it never waits for the rate limiter
+        if rate_limiter is not None and not rate_limiter.try_acquire():
+            caches.end_prefetch(database_id)
+            return
+
+        def run(database_id: str = database_id):
+            try:
+                find_notion_database_form(notion, caches, database_id)
+            except Exception as e:
+                logger.debug(f"Failed to prefetch a Notion database (id: {database_id}, error: {e})")
+            finally:
+                caches.end_prefetch(database_id)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+DATABASE_FILTER = {"property": "object", "value": "database"}
+LAST_EDITED_DESC = {"direction": "descending", "timestamp": "last_edited_time"}
+
+
+def iter_notion_databases(
+    notion: Client,
+    query: Optional[str] = None,
+    sort: Optional[dict] = None,
+    deadline: Optional[float] = None,
+) -> Iterator[dict]:
+    """Yields the databases in Notion's search results page by page, stopping early once the deadline (monotonic) passes."""
+    params = {"filter": DATABASE_FILTER}
+    if query:
+        params["query"] = query
+    if sort is not None:
+        params["sort"] = sort
+    cursor = None
+    while deadline is None or time.monotonic() < deadline:
+        try:
+            with notion_call_deadline(deadline):
+                page = notion.search(**params, start_cursor=cursor)
+        except RequestTimeoutError:
+            if deadline is None:
+                raise
+            # The time budget ran out while Notion was still searching
+            return
+        yield from page["results"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
+
+
+def sync_notion_database_directory(notion: Client, directory: NotionDatabaseDirectory) -> None:
+    if directory.needs_full_sync():
+        directory.replace_all(iter_notion_databases(notion))
+        return
+
+    # Incremental sync: walk the recently edited databases until we reach the ones we already know
+    watermark = directory.watermark
+    updated = []
+    for database in iter_notion_databases(notion, sort=LAST_EDITED_DESC):
+        if watermark is not None and database["last_edited_time"] < watermark:
+            break
+        updated.append(database)
+    directory.upsert(updated)
+
+
+def search_notion_databases(notion: Client, query: Optional[str], deadline: float, limit: int = 100) -> List[dict]:
+    """Uses Notion's own title search, for when the directory is not loaded yet."""
     databases = []
-    query = payload.get("value")
-    database_filter = {"property": "object", "value": "database"}
+    sort = None if query else LAST_EDITED_DESC
+    for database in iter_notion_databases(notion, query=query, sort=sort, deadline=deadline):
+        databases.append(database)
+        if len(databases) >= limit:
+            break
+    return databases
+
+
+def refresh_notion_database_directory(notion: Client, directory: NotionDatabaseDirectory, logger: logging.Logger):
+    if not directory.begin_refresh():
+        return
+
+    def run():
+        try:
+            sync_notion_database_directory(notion, directory)
+        except Exception as e:
+            logger.warning(f"Failed to refresh the Notion database directory (error: {e})")
+        finally:
+            directory.end_refresh()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def build_notion_database_options(
+    notion: Client,
+    directory: NotionDatabaseDirectory,
+    payload: dict,
+    logger: logging.Logger,
+    time_budget_seconds: float = 2.0,
+) -> List[Dict[str, Any]]:
+    refresh_notion_database_directory(notion, directory, logger)
+    if directory.is_loaded:
+        return search_database_options(directory, payload)
+
+    # Until the initial full sync in the background is done, answer with as many matches as Notion's search
+    # returns within the time budget, so that a large workspace does not make the request miss Slack's 3 seconds
+    deadline = time.monotonic() + time_budget_seconds
+    databases = search_notion_databases(notion, payload.get("value"), deadline)
+    return build_database_options(rank_entries([directory.to_entry(d) for d in databases], payload.get("value")))
+
+
+def search_database_options(directory: NotionDatabaseDirectory, payload: dict) -> List[Dict[str, Any]]:
+    return build_database_options(directory.search(payload.get("value")))
+
+
+def build_database_options(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{"text": {"type": "plain_text", "text": e["title"][:75]}, "value": e["id"]} for e in entries]
+
+
+def build_notion_property_options(notion: Client, caches: NotionCaches, payload: dict) -> List[Dict[str, Any]]:
+    database_id = json.loads(payload["view"]["private_metadata"])["notion_database_id"]
+    form = find_notion_database_form(notion, caches, database_id)
+    return search_property_options(form, payload)
+
+
+def search_property_options(form: Dict[str, Any], payload: dict) -> List[Dict[str, Any]]:
+    index = form["option_indexes"].get(strip_generation(payload["block_id"]))
+    if index is None:
+        return []
+    return [_build_option(o) for o in index.search(payload.get("value"))]
+
+
+def sync_notion_page_index(notion: Client, database_id: str, index: NotionPageTitleIndex) -> None:
+    if index.needs_full_sync():
+        pages = []
+        cursor = None
+        while True:
+            page = notion.databases.query(database_id=database_id, start_cursor=cursor, page_size=100)
+            pages.extend(page["results"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        index.replace_all(pages)
+        return
+
+    # Incremental sync: only the pages edited since the newest one we already know
+    query = {"database_id": database_id, "page_size": 100}
+    if index.watermark is not None:
+        query["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": index.watermark}}
+    cursor = None
+    while True:
+        page = notion.databases.query(**query, start_cursor=cursor)
+        index.upsert(page["results"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+
+def search_notion_pages(
+    notion: Client,
+    database_id: str,
+    query: Optional[str],
+    deadline: float,
+    limit: int = 100,
+) -> List[dict]:
+    """Uses Notion's own title filter, for when the page index is not loaded yet."""
+    params: Dict[str, Any] = {"database_id": database_id, "page_size": 100}
+    if query:
+        # The title property's id is always "title"
+        params["filter"] = {"property": "title", "title": {"contains": query}}
+    else:
+        params["sorts"] = [LAST_EDITED_DESC]
+    pages = []
     cursor = None
-    first_page = notion.search(query=query, filter=database_filter, start_cursor=cursor)
-    databases = databases + first_page["results"]
-    cursor = first_page["next_cursor"]
-    while cursor is not None:
-        page = notion.search(query=query, filter=database_filter, start_cursor=cursor)
-        databases = databases + page["results"]
+    while time.monotonic() < deadline and len(pages) < limit:
+        try:
+            with notion_call_deadline(deadline):
+                page = notion.databases.query(**params, start_cursor=cursor)
+        except RequestTimeoutError:
+            # The time budget ran out while Notion was still querying
+            break
+        pages.extend(page["results"])
         cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    return pages[:limit]
+
+
+def refresh_notion_page_index(notion: Client, database_id: str, index: NotionPageTitleIndex, logger: logging.Logger):
+    if not index.begin_refresh():
+        return
+
+    def run():
+        try:
+            sync_notion_page_index(notion, database_id, index)
+        except Exception as e:
+            logger.warning(f"Failed to refresh the page index of a Notion database (id: {database_id}, error: {e})")
+        finally:
+            index.end_refresh()
+
+    threading.Thread(target=run, daemon=True).start()
+
 
-    options = []
-    for database in databases:
-        database_id = database["id"]
-        database_name = database["title"][0]["plain_text"]
-        options.append({"text": {"type": "plain_text", "text": database_name}, "value": database_id})
-    return options
+def build_notion_relation_options(
+    notion: Client,
+    caches: NotionCaches,
+    payload: dict,
+    logger: logging.Logger,
+    time_budget_seconds: float = 2.0,
+) -> List[Dict[str, Any]]:
+    database_id = json.loads(payload["view"]["private_metadata"])["notion_database_id"]
+    form = find_notion_database_form(notion, caches, database_id)
+    related_database_id = find_related_database_id(form["database"], strip_generation(payload["block_id"]))
+    if related_database_id is None:
+        return []
+    index = caches.page_index(related_database_id)
+    refresh_notion_page_index(notion, related_database_id, index, logger)
+    if index.is_loaded:
+        return search_relation_options(index, payload)
+
+    # Until the initial full sync in the background is done, answer with the matches that Notion returns
+    # within the time budget, as a related database with thousands of pages can't be loaded in Slack's 3 seconds
+    deadline = time.monotonic() + time_budget_seconds
+    pages = search_notion_pages(notion, related_database_id, payload.get("value"), deadline)
+    return build_database_options(rank_entries([index.to_entry(p) for p in pages], payload.get("value")))
+
+
+def find_related_database_id(database: dict, property_id: str) -> Optional[str]:
+    for prop in database["properties"].values():
+        if prop.get("id") == property_id and prop.get("type") == "relation":
+            return prop["relation"]["database_id"]
+    return None
+
+
+def search_relation_options(index: NotionPageTitleIndex, payload: dict) -> List[Dict[str, Any]]:
+    return build_database_options(index.search(payload.get("value")))
 
 
 def _build_option(o: dict) -> dict:
     return {
-        "text": {"type": "plain_text", "text": o["name"]},
+        "text": {"type": "plain_text", "text": o["name"][:75]},
         "value": o["id"],
     }
 
 
+# Slack does not accept modals with more blocks than this
+MAX_MODAL_BLOCKS = 100
+
+# Batch entry clears a form's inputs by adding a generation suffix to their block_ids.
+# Notion property ids are URL-encoded and never contain ":", so the suffix can always be told apart.
+_GENERATION_SUFFIX_PATTERN = re.compile(r"::\d+$")
+
+
+def with_generation(block_id: str, generation: int) -> str:
+    return f"{strip_generation(block_id)}::{generation}"
+
+
+def strip_generation(block_id: str) -> str:
+    """Returns the Notion property id that a form input's block_id was built from."""
+    return _GENERATION_SUFFIX_PATTERN.sub("", block_id)
+
+
+def _build_select_element(prop_type: str, options: List[Dict[str, Any]]) -> dict:
+    multi = "multi_" if prop_type == "multi_select" else ""
+    if len(options) > MAX_STATIC_SELECT_OPTIONS:
+        # Large option sets are searched on demand by the options handler instead of being embedded in the modal
+        return {"type": f"{multi}external_select", "min_query_length": 0, "action_id": prop_type}
+    return {"type": f"{multi}static_select", "options": [_build_option(o) for o in options], "action_id": prop_type}
+
+
 def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
     blocks = []
     database_name = database["title"][0]["plain_text"][:24]
@@ -53,7 +324,7 @@ def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
         },
     )
     title_key = list(filter(lambda p: p[1]["type"] == "title", database["properties"].items()))[0][0]
-    title = database["properties"].pop(title_key)
+    title = database["properties"][title_key]
     blocks.append(
         {
             "type": "input",
@@ -64,6 +335,8 @@ def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
         }
     )
     for name, prop in database["properties"].items():
+        if name == title_key:
+            continue
         prop_type = prop.get("type", "text")
         label = {"type": "plain_text", "text": name}
         block_id = prop.get("id", name)
@@ -72,11 +345,7 @@ def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
                 {
                     "type": "input",
                     "block_id": block_id,
-                    "element": {
-                        "type": "static_select",
-                        "options": [_build_option(o) for o in prop["select"]["options"]],
-                        "action_id": prop_type,
-                    },
+                    "element": _build_select_element(prop_type, prop["select"]["options"]),
                     "label": label,
                     "optional": True,
                 }
@@ -86,11 +355,7 @@ def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
                 {
                     "type": "input",
                     "block_id": block_id,
-                    "element": {
-                        "type": "multi_static_select",
-                        "options": [_build_option(o) for o in prop["multi_select"]["options"]],
-                        "action_id": prop_type,
-                    },
+                    "element": _build_select_element(prop_type, prop["multi_select"]["options"]),
                     "label": label,
                     "optional": True,
                 }
@@ -125,6 +390,28 @@ def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
                     "optional": True,
                 }
             )
+        elif prop_type == "relation":
+            blocks.append(
+                {
+                    "type": "input",
+                    "block_id": block_id,
+                    # The related database's pages are searched on demand by the options handler
+                    "element": {"type": "multi_external_select", "min_query_length": 0, "action_id": prop_type},
+                    "label": label,
+                    "optional": True,
+                }
+            )
+        elif prop_type == "people":
+            blocks.append(
+                {
+                    "type": "input",
+                    "block_id": block_id,
+                    # The selected Slack users are mapped to Notion users by their email addresses
+                    "element": {"type": "multi_users_select", "action_id": prop_type},
+                    "label": label,
+                    "optional": True,
+                }
+            )
         elif prop_type == "checkbox":
             blocks.append(
                 {
@@ -147,16 +434,14 @@ def build_input_blocks(database: dict) -> List[Dict[str, Any]]:
             )
 
         # The following ones are not yet supported
-        # people
-        # relation
         # formula
         # rollup
         # files
 
-    return blocks
+    return blocks[:MAX_MODAL_BLOCKS]
 
 
-def to_page_properties(state_values: dict) -> dict:
+def to_page_properties(state_values: dict, user_index: Optional[SlackNotionUserIndex] = None) -> dict:
     properties = {}
     for block_id, v in state_values.items():
         action_id = list(v.keys())[0]
@@ -167,6 +452,12 @@ def to_page_properties(state_values: dict) -> dict:
         elif action_id == "multi_select" and v[action_id].get("selected_options") is not None:
             selected_options = [{"id": o["value"]} for o in v[action_id]["selected_options"]]
             properties[block_id] = {"multi_select": selected_options}
+        elif action_id == "relation" and v[action_id].get("selected_options") is not None:
+            properties[block_id] = {"relation": [{"id": o["value"]} for o in v[action_id]["selected_options"]]}
+        elif action_id == "people" and v[action_id].get("selected_users") is not None and user_index is not None:
+            # Slack users without a Notion account with the same email address are left out
+            notion_user_ids = [user_index.get(u) for u in v[action_id]["selected_users"]]
+            properties[block_id] = {"people": [{"id": u} for u in notion_user_ids if u is not None]}
         elif action_id == "rich_text" and v[action_id].get("value") is not None:
             properties[block_id] = {"rich_text": [{"text": {"content": v[action_id]["value"]}}]}
         elif action_id == "number" and v[action_id].get("value") is not None:
@@ -184,9 +475,117 @@ def to_page_properties(state_values: dict) -> dict:
     return properties
 
 
-def send_to_notion(notion: Client, database_id: str, state_values: dict):
+_CSV_TRUE_VALUES = ("true", "yes", "y", "1", "x", "checked")
+
+
+def csv_row_to_state_values(database: dict, row: Dict[str, str]) -> Tuple[dict, List[str]]:
+    """Builds the same shape as a modal's state values from a CSV row so that to_page_properties can convert it."""
+    state_values = {}
+    errors = []
+    properties = {name.strip().lower(): prop for name, prop in database["properties"].items()}
+    for column, value in row.items():
+        prop = properties.get((column or "").strip().lower())
+        value = (value or "").strip()
+        if prop is None or len(value) == 0:
+            continue
+        prop_type = prop["type"]
+        block_id = prop["id"]
+        if prop_type in ("title", "rich_text", "number", "url", "email", "phone_number"):
+            state_values[block_id] = {prop_type: {"value": value}}
+        elif prop_type in ("select", "multi_select"):
+            option_ids = {o["name"].lower(): o["id"] for o in prop[prop_type]["options"]}
+            names = [value] if prop_type == "select" else [v.strip() for v in value.split(",") if v.strip()]
+            unknown = [n for n in names if n.lower() not in option_ids]
+            if len(unknown) > 0:
+                errors.append(f"{column}: unknown option(s) {', '.join(unknown)}")
+                continue
+            selected = [{"value": option_ids[n.lower()]} for n in names]
+            if prop_type == "select":
+                state_values[block_id] = {"select": {"selected_option": selected[0]}}
+            else:
+                state_values[block_id] = {"multi_select": {"selected_options": selected}}
+        elif prop_type == "date":
+            state_values[block_id] = {"date": {"selected_date": value}}
+        elif prop_type == "checkbox":
+            checked = value.lower() in _CSV_TRUE_VALUES
+            state_values[block_id] = {"checkbox": {"selected_options": [{"value": "checked"}] if checked else []}}
+    return state_values, errors
+
+
+def find_csv_title_column(database: dict, columns: Iterable[Optional[str]]) -> Optional[str]:
+    """Returns the CSV column that csv_row_to_state_values maps to the database's title property, if any."""
+    title_names = {name.strip().lower() for name, prop in database["properties"].items() if prop["type"] == "title"}
+    for column in columns:
+        if (column or "").strip().lower() in title_names:
+            return column
+    return None
+
+
+def send_to_notion(
+    notion: Client,
+    database_id: str,
+    state_values: dict,
+    user_index: Optional[SlackNotionUserIndex] = None,
+    children: Optional[List[dict]] = None,
+):
+    params = {}
+    if children is not None:
+        # The first blocks of the page's content can be sent together, up to 100 blocks
+        params["children"] = children
     new_page = notion.pages.create(
         parent={"type": "database_id", "database_id": database_id},
-        properties=to_page_properties(state_values),
+        properties=to_page_properties(state_values, user_index),
+        **params,
     )
     return new_page
+
+
+def sync_slack_notion_user_index(slack_client: WebClient, notion: Client, index: SlackNotionUserIndex) -> None:
+    slack_user_emails = {}
+    cursor = None
+    while True:
+        response = slack_client.users_list(cursor=cursor, limit=200)
+        for user in response["members"]:
+            email = user.get("profile", {}).get("email")
+            if email is not None and not user.get("deleted") and not user.get("is_bot"):
+                slack_user_emails[user["id"]] = email
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            break
+
+    notion_user_ids_by_email = {}
+    cursor = None
+    while True:
+        page = notion.users.list(start_cursor=cursor, page_size=100)
+        for user in page["results"]:
+            email = user.get("person", {}).get("email") if user.get("type") == "person" else None
+            if email is not None:
+                notion_user_ids_by_email[email.lower()] = user["id"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    index.replace_all(slack_user_emails, notion_user_ids_by_email)
+
+
+def start_slack_notion_user_index_sync(
+    slack_client: WebClient,
+    notion: Client,
+    index: SlackNotionUserIndex,
+    interval_seconds: float,
+    logger: logging.Logger,
+) -> threading.Thread:
+    """Builds the index right away in the background and then rebuilds it every interval_seconds."""
+
+    def run():
+        while True:
+            try:
+                sync_slack_notion_user_index(slack_client, notion, index)
+                logger.debug(f"Synced the Slack to Notion user index ({len(index)} users)")
+            except Exception as e:
+                logger.warning(f"Failed to sync the Slack to Notion user index (error: {e})")
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=run, name="slack-notion-user-index-sync", daemon=True)
+    thread.start()
+    return thread
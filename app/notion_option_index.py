@@ -0,0 +1,56 @@
+from typing import List, Dict, Any, Optional
+
+# Slack does not accept more options than this in static_select / multi_static_select elements
+MAX_STATIC_SELECT_OPTIONS = 100
+
+
+class NotionOptionIndex:
+    """In-memory search index of a select / multi_select property's options.
+
+    Matches are ranked as exact, prefix, word prefix, substring and then fuzzy (the keyword's
+    characters appear in order), so that typeahead responses stay small however many options there are.
+    """
+
+    def __init__(self, options: List[Dict[str, Any]]):
+        self._entries = [{"id": o["id"], "name": o["name"], "normalized_name": o["name"].lower()} for o in options]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def search(self, query: Optional[str], limit: int = MAX_STATIC_SELECT_OPTIONS) -> List[Dict[str, Any]]:
+        keyword = (query or "").strip().lower()
+        if len(keyword) == 0:
+            return self._entries[:limit]
+
+        ranked = []
+        for entry in self._entries:
+            rank = self._rank(entry["normalized_name"], keyword)
+            if rank is not None:
+                ranked.append((rank, len(entry["normalized_name"]), entry["normalized_name"], entry))
+        ranked.sort(key=lambda r: r[:3])
+        return [r[3] for r in ranked[:limit]]
+
+    @staticmethod
+    def _rank(name: str, keyword: str) -> Optional[int]:
+        if name == keyword:
+            return 0
+        if name.startswith(keyword):
+            return 1
+        if any(word.startswith(keyword) for word in name.split()):
+            return 2
+        if keyword in name:
+            return 3
+        chars = iter(name)
+        if all(c in chars for c in keyword):
+            return 4
+        return None
+
+
+def build_option_indexes(database: dict) -> Dict[str, NotionOptionIndex]:
+    """Builds indexes for the select / multi_select properties that have too many options for a static select."""
+    indexes = {}
+    for name, prop in database["properties"].items():
+        prop_type = prop.get("type")
+        if prop_type in ("select", "multi_select") and len(prop[prop_type]["options"]) > MAX_STATIC_SELECT_OPTIONS:
+            indexes[prop.get("id", name)] = NotionOptionIndex(prop[prop_type]["options"])
+    return indexes
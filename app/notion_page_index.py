@@ -0,0 +1,28 @@
+from typing import Dict, Any
+
+from app.notion_database_directory import NotionDatabaseDirectory
+
+
+def page_title(page: dict) -> str:
+    for prop in page.get("properties", {}).values():
+        if prop.get("type") == "title":
+            return "".join(t.get("plain_text", "") for t in prop.get("title", [])) or "Untitled"
+    return "Untitled"
+
+
+class NotionPageTitleIndex(NotionDatabaseDirectory):
+    """In-memory index of the page titles in a single Notion database, used as the options of relation properties.
+
+    It works the same way as the database directory: the functions in app.notion_ops fill it with
+    a full sync and then incremental syncs that only query the pages edited since the last sync.
+    """
+
+    @staticmethod
+    def to_entry(page: dict) -> Dict[str, Any]:
+        title = page_title(page)
+        return {
+            "id": page["id"],
+            "title": title,
+            "normalized_title": title.lower(),
+            "last_edited_time": page.get("last_edited_time", ""),
+        }
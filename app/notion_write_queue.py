@@ -0,0 +1,458 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional, List, Dict, Any, Iterator
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from app.idempotency import IdempotencyStore
+from app.notion_caches import NotionCachesRegistry
+from app.notion_clients import NotionClientRegistry
+from app.notion_ops import send_to_notion
+from app.rate_limiter import TokenBucketRegistry, is_rate_limited, is_retryable, retry_after_seconds
+from app.slack_message_export import append_notion_blocks, iter_in_background, iter_message_export_blocks, take_batch
+from app.slack_views import (
+    build_message_view,
+    build_saved_message,
+    build_batch_summary_message,
+    SENDING_DATA_FAILED_MESSAGE,
+)
+
+# Both resolvers receive the enterprise_id and team_id of the Slack workspace where the data was submitted
+NotionTokenResolver = Callable[[Optional[str], Optional[str]], str]
+SlackClientResolver = Callable[[Optional[str], Optional[str]], WebClient]
+
+
+class NotionWriteQueue:
+    """Durable queue of Notion page writes backed by a SQLite file.
+
+    Submissions are stored before any Notion API call, so that writes still pending
+    when the process stops are sent after the next start. A bounded number of worker
+    threads drain the queue under a per-token rate limit that honors Retry-After.
+
+    Several processes can share the same file. A claimed write is leased to one worker
+    for lease_seconds, and it goes back to the queue if the worker's process stops before
+    finishing it.
+
+    A write enqueued with an idempotency key is not sent again once the idempotency store knows
+    its page, for instance when its lease expired after the page was created.
+
+    Writes enqueued with a batch_id are reported together. Once the batch is closed and
+    all of its writes are done or failed, a summary of the created pages is posted.
+
+    Finished writes and batches are deleted retention_seconds after they were submitted, as they
+    hold the submitted data in plaintext.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        notion_clients: NotionClientRegistry,
+        notion_caches: NotionCachesRegistry,
+        resolve_notion_token: NotionTokenResolver,
+        resolve_slack_client: SlackClientResolver,
+        rate_limiters: TokenBucketRegistry,
+        workers: int = 2,
+        max_attempts: int = 5,
+        lease_seconds: float = 300,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        retention_seconds: float = 86400 * 7,
+        cleanup_interval_seconds: float = 3600,
+        logger: logging.Logger = logging.getLogger(__name__),
+    ):
+        self.notion_clients = notion_clients
+        self.notion_caches = notion_caches
+        self.resolve_notion_token = resolve_notion_token
+        self.resolve_slack_client = resolve_slack_client
+        self.workers = workers
+        self.rate_limiters = rate_limiters
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.idempotency_store = idempotency_store if idempotency_store is not None else IdempotencyStore()
+        self.retention_seconds = retention_seconds
+        self.cleanup_interval_seconds = cleanup_interval_seconds
+        self.logger = logger
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS notion_writes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                enterprise_id TEXT,
+                team_id TEXT,
+                user_id TEXT NOT NULL,
+                view_id TEXT,
+                database_id TEXT NOT NULL,
+                state_values TEXT NOT NULL,
+                message TEXT,
+                idempotency_key TEXT,
+                batch_id TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                page_url TEXT,
+                error TEXT,
+                created_at REAL NOT NULL
+            )
+            """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS notion_writes_pending ON notion_writes (status, next_attempt_at)")
+        # Files created by older versions of this app don't have these columns yet
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(notion_writes)")]
+        for column in ("message", "idempotency_key", "batch_id"):
+            if column not in columns:
+                try:
+                    self._conn.execute(f"ALTER TABLE notion_writes ADD COLUMN {column} TEXT")
+                except sqlite3.OperationalError:
+                    # another process has just added it
+                    pass
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS notion_write_batches (
+                batch_id TEXT PRIMARY KEY,
+                enterprise_id TEXT,
+                team_id TEXT,
+                user_id TEXT NOT NULL,
+                view_id TEXT,
+                summarized INTEGER NOT NULL DEFAULT 0,
+                closed_at REAL NOT NULL
+            )
+            """)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._enqueued_signals = 0
+        self._next_cleanup_at = 0.0
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run_worker, name=f"notion-write-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def enqueue(
+        self,
+        *,
+        enterprise_id: Optional[str],
+        team_id: Optional[str],
+        user_id: str,
+        view_id: Optional[str],
+        database_id: str,
+        state_values: dict,
+        message: Optional[dict] = None,
+        idempotency_key: Optional[str] = None,
+        batch_id: Optional[str] = None,
+    ) -> int:
+        """Queues a page creation. When message is given, the Slack messages it points to become the page's content."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO notion_writes (enterprise_id, team_id, user_id, view_id, database_id, state_values, "
+                "message, idempotency_key, batch_id, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    enterprise_id,
+                    team_id,
+                    user_id,
+                    view_id,
+                    database_id,
+                    json.dumps(state_values),
+                    json.dumps(message) if message is not None else None,
+                    idempotency_key,
+                    batch_id,
+                    now,
+                    now,
+                ),
+            )
+            job_id = cursor.lastrowid
+        with self._wakeup:
+            self._enqueued_signals += 1
+            self._wakeup.notify()
+        return job_id
+
+    def close_batch(
+        self,
+        *,
+        batch_id: str,
+        enterprise_id: Optional[str],
+        team_id: Optional[str],
+        user_id: str,
+        view_id: Optional[str] = None,
+    ) -> None:
+        """Marks that no more writes are added to the batch. The summary is posted once its writes are finished."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO notion_write_batches (batch_id, enterprise_id, team_id, user_id, view_id, closed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (batch_id, enterprise_id, team_id, user_id, view_id, time.time()),
+            )
+        self._summarize_batch_if_finished(batch_id)
+
+    def delete_expired(self) -> int:
+        """Deletes the finished writes and the batches older than retention_seconds, and returns how many writes."""
+        expires_before = time.time() - self.retention_seconds
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM notion_writes WHERE status IN ('done', 'failed') AND created_at < ?",
+                (expires_before,),
+            )
+            self._conn.execute("DELETE FROM notion_write_batches WHERE closed_at < ?", (expires_before,))
+        return cursor.rowcount
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            # The write lock makes the claim atomic across the processes sharing the file
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # A running write whose lease expired was left behind by a process that stopped
+                row = self._conn.execute(
+                    "SELECT id, enterprise_id, team_id, user_id, view_id, database_id, state_values, message, "
+                    "idempotency_key, batch_id, attempts FROM notion_writes "
+                    "WHERE status IN ('pending', 'running') AND next_attempt_at <= ? ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE notion_writes SET status = 'running', next_attempt_at = ? WHERE id = ?",
+                        (now + self.lease_seconds, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        keys = [
+            "id",
+            "enterprise_id",
+            "team_id",
+            "user_id",
+            "view_id",
+            "database_id",
+            "state_values",
+            "message",
+            "idempotency_key",
+            "batch_id",
+            "attempts",
+        ]
+        job = dict(zip(keys, row))
+        job["state_values"] = json.loads(job["state_values"])
+        job["message"] = json.loads(job["message"]) if job["message"] is not None else None
+        return job
+
+    def _seconds_until_next_job(self) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM notion_writes WHERE status IN ('pending', 'running')",
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(row[0] - time.time(), 0)
+
+    def _cleanup_if_due(self) -> None:
+        with self._lock:
+            if time.time() < self._next_cleanup_at:
+                return
+            self._next_cleanup_at = time.time() + self.cleanup_interval_seconds
+        try:
+            deleted = self.delete_expired()
+            if deleted > 0:
+                self.logger.info(f"Deleted {deleted} finished Notion writes older than {self.retention_seconds} seconds")
+        except sqlite3.Error as e:
+            self.logger.warning(f"Failed to delete the expired Notion writes (error: {e})")
+
+    def _run_worker(self) -> None:
+        while not self._stopped:
+            self._cleanup_if_due()
+            job = self._claim()
+            if job is None:
+                wait_seconds = self._seconds_until_next_job()
+                with self._wakeup:
+                    if self._enqueued_signals > 0:
+                        # something was enqueued after the claim attempt above
+                        self._enqueued_signals -= 1
+                    elif not self._stopped:
+                        # other processes sharing the file do not signal this one, so never sleep for long
+                        self._wakeup.wait(timeout=min(wait_seconds, 5) if wait_seconds is not None else 5)
+                continue
+            try:
+                self._process(job)
+            except Exception as e:
+                self.logger.exception(f"Unexpectedly failed to process a Notion write (id: {job['id']}, error: {e})")
+
+    def _process(self, job: Dict[str, Any]) -> None:
+        record = self.idempotency_store.find(job["idempotency_key"]) if job["idempotency_key"] is not None else None
+        if record is not None and record.get("page_url") is not None:
+            self.logger.info(f"Skipped a Notion write whose page already exists (id: {job['id']})")
+            self._mark_done(job, job["attempts"], record["page_url"])
+            self._notify_success(job, record["page_url"])
+            return
+        notion_token = self.resolve_notion_token(job["enterprise_id"], job["team_id"])
+        rate_limiter = self.rate_limiters.get(notion_token)
+        if not rate_limiter.try_acquire():
+            # Sleeping here would hold up the writes of the other Notion workspaces too
+            self._postpone(job, rate_limiter.seconds_until_available())
+            return
+        body = None
+        try:
+            if job["message"] is not None:
+                # Slack messages are read in the background while the blocks already converted are sent to Notion
+                slack_client = self.resolve_slack_client(job["enterprise_id"], job["team_id"])
+                body = iter_in_background(iter_message_export_blocks(slack_client, job["message"], self.logger))
+            self._create_page(job, notion_token, body)
+        finally:
+            if body is not None:
+                body.close()
+
+    def _postpone(self, job: Dict[str, Any], delay: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE notion_writes SET status = 'pending', next_attempt_at = ? WHERE id = ?",
+                (time.time() + delay, job["id"]),
+            )
+
+    def _create_page(self, job: Dict[str, Any], notion_token: str, body: Optional[Iterator[dict]]) -> None:
+        notion = self.notion_clients.get(notion_token)
+        rate_limiter = self.rate_limiters.get(notion_token)
+        attempts = job["attempts"] + 1
+        try:
+            # The first blocks of the content are sent along with the page
+            children = take_batch(body) if body is not None else None
+        except Exception as e:
+            # Errors other than Slack API errors, such as lost connections, stop reading the Slack messages
+            self._retry_or_fail(job, attempts, e, retryable=True, delay=min(2**attempts, 60))
+            return
+        try:
+            new_page = send_to_notion(
+                notion,
+                job["database_id"],
+                job["state_values"],
+                self.notion_caches.get(notion_token).user_index(job["enterprise_id"], job["team_id"]),
+                children,
+            )
+        except Exception as e:
+            if is_rate_limited(e):
+                rate_limiter.pause(retry_after_seconds(e))
+            delay = retry_after_seconds(e) if is_rate_limited(e) else min(2**attempts, 60)
+            self._retry_or_fail(job, attempts, e, retryable=is_retryable(e), delay=delay)
+            return
+
+        page_url = new_page["url"]
+        if job["idempotency_key"] is not None:
+            self.idempotency_store.complete(job["idempotency_key"], page_url)
+        # Marked as done before appending the rest of the content, which must never create the page again
+        self._mark_done(job, attempts, page_url)
+        if body is not None:
+            try:
+                append_notion_blocks(notion, new_page["id"], body, rate_limiter, self.max_attempts)
+            except Exception as e:
+                self.logger.exception(f"Failed to copy the Slack messages into a Notion page (id: {job['id']}, error: {e})")
+                client = self.resolve_slack_client(job["enterprise_id"], job["team_id"])
+                client.chat_postMessage(
+                    channel=job["user_id"],
+                    text=f":warning: The page {page_url} was created, but copying the Slack messages into it stopped "
+                    f"partway (error: {e})",
+                )
+        self._notify_success(job, page_url)
+
+    def _retry_or_fail(self, job: Dict[str, Any], attempts: int, e: Exception, retryable: bool, delay: float) -> None:
+        if retryable and attempts < self.max_attempts:
+            self.logger.warning(f"Retrying a Notion write in {delay} seconds (id: {job['id']}, error: {e})")
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE notion_writes SET status = 'pending', attempts = ?, next_attempt_at = ?, error = ? WHERE id = ?",
+                    (attempts, time.time() + delay, str(e), job["id"]),
+                )
+            return
+        self.logger.exception(e)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE notion_writes SET status = 'failed', attempts = ?, error = ? WHERE id = ?",
+                (attempts, str(e), job["id"]),
+            )
+        self._notify_failure(job, e)
+
+    def _mark_done(self, job: Dict[str, Any], attempts: int, page_url: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE notion_writes SET status = 'done', attempts = ?, page_url = ?, error = NULL WHERE id = ?",
+                (attempts, page_url, job["id"]),
+            )
+
+    def _notify_success(self, job: Dict[str, Any], page_url: str) -> None:
+        if job["batch_id"] is not None:
+            self._summarize_batch_if_finished(job["batch_id"])
+            return
+        client = self.resolve_slack_client(job["enterprise_id"], job["team_id"])
+        if self._update_view(client, job, build_saved_message(page_url)):
+            return
+        # The modal is already closed, so let the user know in a DM instead
+        client.chat_postMessage(channel=job["user_id"], text=build_saved_message(page_url))
+
+    def _notify_failure(self, job: Dict[str, Any], e: Exception) -> None:
+        if job["batch_id"] is not None:
+            self._summarize_batch_if_finished(job["batch_id"])
+            return
+        client = self.resolve_slack_client(job["enterprise_id"], job["team_id"])
+        self._update_view(client, job, SENDING_DATA_FAILED_MESSAGE)
+        client.chat_postMessage(
+            channel=job["user_id"],
+            text=f"I'm sorry for being distracted! This app failed to send your data to Notion (error: {e})\n"
+            "Please contact this app's user support email address :bow:",
+        )
+
+    def _summarize_batch_if_finished(self, batch_id: str) -> None:
+        with self._lock:
+            # Both the last write and close_batch() call this, possibly in different processes, so only one of them posts
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                batch = self._conn.execute(
+                    "SELECT enterprise_id, team_id, user_id, view_id FROM notion_write_batches "
+                    "WHERE batch_id = ? AND summarized = 0",
+                    (batch_id,),
+                ).fetchone()
+                unfinished = self._conn.execute(
+                    "SELECT COUNT(*) FROM notion_writes WHERE batch_id = ? AND status IN ('pending', 'running')",
+                    (batch_id,),
+                ).fetchone()[0]
+                rows = []
+                if batch is not None and unfinished == 0:
+                    self._conn.execute("UPDATE notion_write_batches SET summarized = 1 WHERE batch_id = ?", (batch_id,))
+                    rows = self._conn.execute(
+                        "SELECT status, page_url, error FROM notion_writes WHERE batch_id = ? ORDER BY id",
+                        (batch_id,),
+                    ).fetchall()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if batch is None or unfinished > 0:
+            return
+
+        enterprise_id, team_id, user_id, view_id = batch
+        page_urls = [page_url for status, page_url, _ in rows if status == "done"]
+        errors = [error for status, _, error in rows if status == "failed"]
+        text = build_batch_summary_message(page_urls, errors)
+        client = self.resolve_slack_client(enterprise_id, team_id)
+        self._update_view(client, {"id": batch_id, "view_id": view_id}, text)
+        client.chat_postMessage(channel=user_id, text=text)
+
+    def _update_view(self, client: WebClient, job: Dict[str, Any], text: str) -> bool:
+        if job["view_id"] is None:
+            return False
+        try:
+            client.views_update(view_id=job["view_id"], view=build_message_view("send-to-notion-database", text))
+            return True
+        except SlackApiError as e:
+            self.logger.debug(f"Failed to update the modal view (id: {job['id']}, error: {e.response['error']})")
+            return False
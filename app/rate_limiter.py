@@ -0,0 +1,126 @@
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+import httpx
+from notion_client import APIResponseError
+from notion_client.errors import APIErrorCode, HTTPResponseError, RequestTimeoutError
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiter that can also be paused for a server-specified Retry-After period."""
+
+    def __init__(self, rate_per_second: float = 3, burst: Optional[int] = None):
+        self.rate_per_second = rate_per_second
+        self.capacity = burst if burst is not None else max(int(rate_per_second), 1)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            wait_seconds = self._try_acquire()
+            if wait_seconds <= 0:
+                return
+            time.sleep(wait_seconds)
+
+    def try_acquire(self) -> bool:
+        return self._try_acquire() <= 0
+
+    def seconds_until_available(self) -> float:
+        """How long until try_acquire() can succeed, for callers that come back later instead of sleeping."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+            return max((1 - tokens) / self.rate_per_second, 0)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def _try_acquire(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate_per_second
+
+
+class TokenBucketRegistry:
+    """TokenBucket instances keyed by Notion token, as Notion's rate limits apply per integration.
+
+    Slack's per-workspace limits use the same registry keyed by workspace.
+    """
+
+    def __init__(self, rate_per_second: float = 3, burst: Optional[int] = None):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def get(self, notion_token: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(notion_token)
+            if bucket is None:
+                bucket = TokenBucket(rate_per_second=self.rate_per_second, burst=self.burst)
+                self._buckets[notion_token] = bucket
+            return bucket
+
+
+def is_rate_limited(e: Exception) -> bool:
+    return isinstance(e, APIResponseError) and e.code == APIErrorCode.RateLimited
+
+
+def retry_after_seconds(e: Exception, default: float = 1.0) -> float:
+    if isinstance(e, APIResponseError):
+        value = e.headers.get("Retry-After")
+        if value is not None:
+            try:
+                return max(float(value), 0)
+            except ValueError:
+                pass
+    return default
+
+
+_RETRYABLE_API_ERROR_CODES = (
+    APIErrorCode.RateLimited,
+    APIErrorCode.ConflictError,
+    APIErrorCode.InternalServerError,
+    APIErrorCode.ServiceUnavailable,
+)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, APIResponseError):
+        return e.code in _RETRYABLE_API_ERROR_CODES
+    if isinstance(e, HTTPResponseError):
+        return e.status >= 500
+    return isinstance(e, (RequestTimeoutError, httpx.TransportError))
+
+
+def call_with_retries(call: Callable[[], T], limiter: TokenBucket, max_attempts: int = 5) -> T:
+    """Calls a Notion API under the rate limit, retrying it on rate limiting and transient errors."""
+    attempts = 0
+    while True:
+        attempts += 1
+        limiter.acquire()
+        try:
+            return call()
+        except Exception as e:
+            if is_rate_limited(e):
+                limiter.pause(retry_after_seconds(e))
+            if not is_retryable(e) or attempts >= max_attempts:
+                raise
+            if not is_rate_limited(e):
+                time.sleep(min(2**attempts, 30))
@@ -0,0 +1,78 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Optional
+
+
+class SharedStore:
+    """Key-value store that lets several processes of this app share what they have loaded from Notion.
+
+    This base class stores nothing, which is all a single process needs because its caches
+    already live in memory. Values must be JSON-serializable.
+    """
+
+    def get(self, key: str) -> Optional[Any]:
+        return None
+
+    def put(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        pass
+
+    def try_lock(self, key: str, ttl_seconds: float) -> bool:
+        """Claims a lock that expires after ttl_seconds unless released earlier. Returns False if someone else holds it."""
+        return True
+
+    def release(self, key: str) -> None:
+        pass
+
+
+class SqliteSharedStore(SharedStore):
+    """SharedStore backed by a SQLite file, for the processes of this app running on the same host."""
+
+    def __init__(self, path: str):
+        # Locks are owned by a store instance, so that a process never releases a lock another one claimed
+        self._owner = str(uuid.uuid4())
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS shared_store (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            )
+            """)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM shared_store WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl_seconds if ttl_seconds is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO shared_store (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, separators=(",", ":")), expires_at),
+            )
+
+    def try_lock(self, key: str, ttl_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO shared_store (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE shared_store.expires_at <= ?",
+                (f"lock:{key}", json.dumps(self._owner), now + ttl_seconds, now),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM shared_store WHERE key = ? AND value = ?",
+                (f"lock:{key}", json.dumps(self._owner)),
+            )
@@ -1,89 +1,102 @@
 import json
 import logging
 import os
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
 
 from slack_bolt import App, Ack, Say, BoltContext
 from slack_sdk import WebClient
 
-from notion_client import Client
-
 from app.notion_ops import (
-    find_notion_database,
+    find_notion_database_form,
     build_notion_database_options,
-    build_input_blocks,
-    send_to_notion,
+    build_notion_property_options,
+    build_notion_relation_options,
+    prefetch_notion_database_forms,
+)
+from app.home_tab import HomeTabPublisher
+from app.listener_executor import LazyListenerExecutor
+from app.metrics import Metrics, listener_name, summarize_request, instrument_web_client
+from app.notion_caches import NotionCachesRegistry
+from app.notion_clients import NotionClientRegistry
+from app.notion_csv_import import NotionCsvImporter
+from app.notion_write_queue import NotionWriteQueue
+from app.rate_limiter import TokenBucketRegistry
+from app.slack_views import (
+    build_home_view,
+    build_database_selection_view,
+    build_csv_import_view,
+    find_csv_file,
+    build_message_view,
+    build_send_to_notion_view,
+    build_message_source,
+    selected_message_source,
+    selected_database_id,
+    view_submission_key,
+    is_batch_mode,
+    view_batch_id,
+    build_next_row_view,
+    submitted_state_values,
+    build_saved_message,
+    validate_send_to_notion_submission,
+    LOADING_DATABASE_MESSAGE,
+    LOADING_DATABASE_FAILED_MESSAGE,
+    SENDING_DATA_MESSAGE,
+    SENDING_DATA_FAILED_MESSAGE,
+    BUSY_MESSAGE,
+    NO_CSV_FILE_MESSAGE,
+    CSV_IMPORT_STARTED_MESSAGE,
 )
 
 
-def register_slack_event_handlers(app: App):
+def register_slack_event_handlers(
+    app: App,
+    notion_clients: NotionClientRegistry,
+    notion_caches: NotionCachesRegistry,
+    notion_write_queue: NotionWriteQueue,
+    notion_csv_importer: NotionCsvImporter,
+    notion_rate_limiters: TokenBucketRegistry,
+    listener_executor: Optional[LazyListenerExecutor] = None,
+    schema_prefetch_size: int = 3,
+    metrics: Optional[Metrics] = None,
+    body_log_sample_rate: float = 0.0,
+    options_time_budget_seconds: float = 2.0,
+    home_tab_publisher: Optional[HomeTabPublisher] = None,
+):
     @app.middleware
-    def dump(body: dict, logger: logging.Logger, next_):
-        logger.debug(body)
-        next_()
+    def log_and_time_request(body: dict, context: BoltContext, logger: logging.Logger, next_):
+        # Logging every request body is too expensive under load, so only a sample of them is logged
+        if body_log_sample_rate > 0 and random.random() < body_log_sample_rate:
+            logger.info(json.dumps(summarize_request(body, context)))
+        if metrics is None:
+            next_()
+            return
+        context["client"] = instrument_web_client(context.client, metrics)
+        # Bolt returns from next_() once ack() is done; lazy listeners are timed by the listener executor
+        with metrics.slack_ack_seconds.time(listener=listener_name(body)):
+            next_()
 
     #
     # Home tab
     #
 
     @app.event("app_home_opened")
-    def update_home_tab(client: WebClient, context: BoltContext):
-        client.views_publish(
-            user_id=context.user_id,
-            view={
-                "type": "home",
-                "blocks": [
-                    {
-                        "type": "section",
-                        "block_id": "header",
-                        "text": {"type": "mrkdwn", "text": "*Welcome to Send to Notion in Slack* :raised_hands:"},
-                    },
-                    {
-                        "type": "actions",
-                        "block_id": "open-modal-button",
-                        "elements": [
-                            {
-                                "type": "button",
-                                "text": {"type": "plain_text", "text": "Submit data to Notion"},
-                                "value": "clicked",
-                                "action_id": "open-notion-form",
-                            }
-                        ],
-                    },
-                ],
-            },
-        )
+    def update_home_tab(client: WebClient, context: BoltContext, event: dict):
+        if home_tab_publisher is None:
+            client.views_publish(user_id=context.user_id, view=build_home_view())
+            return
+        key = (context.enterprise_id, context.team_id, context.user_id)
+        if event.get("view") is None:
+            # The user sees no view published by this app, so the one remembered for them is stale
+            home_tab_publisher.forget(key)
+        home_tab_publisher.publish(client, key, build_home_view())
 
     #
     # Send to Notion
     #
 
-    def build_database_selection_view():
-        blocks = [
-            {
-                "type": "input",
-                "block_id": "search-notion-database",
-                "element": {
-                    "type": "external_select",
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "Find a Notion database",
-                    },
-                    "action_id": "search-notion-database",
-                    "min_query_length": 0,
-                },
-                "label": {"type": "plain_text", "text": "Notion Database"},
-            }
-        ]
-
-        return {
-            "type": "modal",
-            "callback_id": "select-notion-database",
-            "title": {"type": "plain_text", "text": "Send to Notion"},
-            "submit": {"type": "plain_text", "text": "Next"},
-            "close": {"type": "plain_text", "text": "Close"},
-            "blocks": blocks,
-        }
-
     def resolve_notion_token(context: BoltContext) -> str:
         token = context.get("notion_token")
         if token is None:
@@ -113,38 +126,118 @@ def register_slack_event_handlers(app: App):
         )
 
     @app.action("go-back-to-database-select-view")
-    def go_back_to_initial_modal_view(ack: Ack, client: WebClient, body: dict):
+    def go_back_to_initial_modal_view(ack: Ack, client: WebClient, body: dict, context: BoltContext):
         ack()
         client.views_update(
             view_id=body["view"]["id"],
             hash=body["view"]["hash"],
-            view=build_database_selection_view(),
+            view=build_database_selection_view(selected_message_source(body["view"])),
+        )
+        batch_id = json.loads(body["view"].get("private_metadata") or "{}").get("batch_id")
+        if batch_id is not None:
+            # Leaving the form ends its batch entry, just like closing it
+            notion_write_queue.close_batch(
+                batch_id=batch_id,
+                enterprise_id=context.enterprise_id,
+                team_id=context.team_id,
+                user_id=context.user_id,
+            )
+
+    @app.shortcut("send-message-to-notion")
+    def open_message_export_form(ack: Ack, client: WebClient, body: dict):
+        ack()
+        client.views_open(
+            trigger_id=body["trigger_id"],
+            view=build_database_selection_view(build_message_source(body["channel"]["id"], body["message"])),
         )
 
     @app.options("search-notion-database")
-    def search_notion_database(ack: Ack, payload: dict, context: BoltContext):
-        notion = Client(auth=resolve_notion_token(context))
-        options = build_notion_database_options(notion, payload)
+    def search_notion_database(ack: Ack, payload: dict, context: BoltContext, logger: logging.Logger):
+        notion_token = resolve_notion_token(context)
+        notion = notion_clients.get(notion_token)
+        directory = notion_caches.get(notion_token).database_directory
+        options = build_notion_database_options(notion, directory, payload, logger, options_time_budget_seconds)
+        ack(options=options)
+        # The user is likely to pick one of the top results, so load their forms before they click Next
+        prefetch_notion_database_forms(
+            notion,
+            notion_caches.get(notion_token),
+            [o["value"] for o in options[:schema_prefetch_size]],
+            notion_rate_limiters.get(notion_token),
+            logger,
+        )
+
+    @app.options("select")
+    @app.options("multi_select")
+    def search_notion_property_options(ack: Ack, payload: dict, context: BoltContext):
+        notion_token = resolve_notion_token(context)
+        notion = notion_clients.get(notion_token)
+        options = build_notion_property_options(notion, notion_caches.get(notion_token), payload)
+        ack(options=options)
+
+    @app.options("relation")
+    def search_notion_relation_options(ack: Ack, payload: dict, context: BoltContext, logger: logging.Logger):
+        notion_token = resolve_notion_token(context)
+        notion = notion_clients.get(notion_token)
+        options = build_notion_relation_options(
+            notion, notion_caches.get(notion_token), payload, logger, options_time_budget_seconds
+        )
         ack(options=options)
 
-    def select_notion_database_ack(ack: Ack):
+    # Whether each view submission was completed in ack(), either by rejecting it because too many lazy listeners
+    # are waiting or by responding with a cached form. Bolt still starts their lazy listeners, which have to do nothing.
+    # Bolt runs ack() and lazy listeners concurrently, so lazy listeners wait for ack() to record the outcome.
+    # An outcome recorded after its lazy listener stopped waiting is never popped, so old ones are dropped.
+    ack_outcomes: Dict[str, Tuple[bool, float]] = {}
+    ack_outcomes_condition = threading.Condition()
+    ack_outcome_ttl_seconds = 60
+
+    def submission_key(view: dict) -> str:
+        return f"{view['id']}:{view.get('hash')}"
+
+    def record_ack_outcome(view: dict, handled: bool) -> None:
+        now = time.monotonic()
+        with ack_outcomes_condition:
+            for key in [k for k, (_, recorded_at) in ack_outcomes.items() if now - recorded_at > ack_outcome_ttl_seconds]:
+                del ack_outcomes[key]
+            ack_outcomes[submission_key(view)] = (handled, now)
+            ack_outcomes_condition.notify_all()
+
+    def was_handled_in_ack(view: dict) -> bool:
+        key = submission_key(view)
+        with ack_outcomes_condition:
+            ack_outcomes_condition.wait_for(lambda: key in ack_outcomes, timeout=3)
+            handled, _ = ack_outcomes.pop(key, (False, 0))
+            return handled
+
+    def reject_if_overloaded(ack: Ack, view: dict) -> bool:
+        if listener_executor is None or listener_executor.overload_policy != "reject":
+            return False
+        if not listener_executor.is_overloaded():
+            return False
+        record_ack_outcome(view, handled=True)
+        # Keep the modal as-is so that the user can submit it again
+        first_block_id = list(view["state"]["values"].keys())[0]
+        ack(response_action="errors", errors={first_block_id: BUSY_MESSAGE})
+        return True
+
+    def select_notion_database_ack(ack: Ack, view: dict, context: BoltContext):
+        database_id = selected_database_id(view)
+        cached = notion_caches.get(resolve_notion_token(context)).find_database_form(database_id)
+        if cached is not None:
+            # Skip the loading view and the extra views.update call when the form is ready
+            record_ack_outcome(view, handled=True)
+            ack(
+                response_action="update",
+                view=build_send_to_notion_view(database_id, cached["blocks"], selected_message_source(view)),
+            )
+            return
+        if reject_if_overloaded(ack, view):
+            return
+        record_ack_outcome(view, handled=False)
         ack(
             response_action="update",
-            view={
-                "type": "modal",
-                "callback_id": "select-notion-database",
-                "title": {"type": "plain_text", "text": "Send to Notion"},
-                "close": {"type": "plain_text", "text": "Close"},
-                "blocks": [
-                    {
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": ":hourglass: Wait a second. Now loading the database ...",
-                        },
-                    }
-                ],
-            },
+            view=build_message_view("select-notion-database", LOADING_DATABASE_MESSAGE),
         )
 
     def select_notion_database_lazy(
@@ -154,44 +247,22 @@ def register_slack_event_handlers(app: App):
         context: BoltContext,
         logger: logging.Logger,
     ):
+        if was_handled_in_ack(view):
+            return
         try:
-            block_key = "search-notion-database"
-            database_id = view["state"]["values"][block_key][block_key]["selected_option"]["value"]
-            notion = Client(auth=resolve_notion_token(context))
-            database = find_notion_database(notion, database_id)
-            blocks = build_input_blocks(database)
+            database_id = selected_database_id(view)
+            notion_token = resolve_notion_token(context)
+            notion = notion_clients.get(notion_token)
+            blocks = find_notion_database_form(notion, notion_caches.get(notion_token), database_id)["blocks"]
             client.views_update(
                 view_id=view["id"],
-                view={
-                    "type": "modal",
-                    "callback_id": "send-to-notion-database",
-                    "title": {"type": "plain_text", "text": "Send to Notion"},
-                    "submit": {"type": "plain_text", "text": "Submit"},
-                    "close": {"type": "plain_text", "text": "Close"},
-                    "private_metadata": json.dumps({"notion_database_id": database_id}),
-                    "blocks": blocks,
-                },
+                view=build_send_to_notion_view(database_id, blocks, selected_message_source(view)),
             )
         except Exception as e:
             logger.exception(e)
             client.views_update(
                 view_id=view["id"],
-                view={
-                    "type": "modal",
-                    "callback_id": "send-to-notion-database",
-                    "title": {"type": "plain_text", "text": "Send to Notion"},
-                    "close": {"type": "plain_text", "text": "Close"},
-                    "blocks": [
-                        {
-                            "type": "section",
-                            "text": {
-                                "type": "mrkdwn",
-                                "text": ":x: Loading Notion database data failed for some reason. "
-                                "Please contact this app's user support email address :bow:",
-                            },
-                        }
-                    ],
-                },
+                view=build_message_view("send-to-notion-database", LOADING_DATABASE_FAILED_MESSAGE),
             )
             say(
                 channel=context.user_id,
@@ -204,43 +275,31 @@ def register_slack_event_handlers(app: App):
         lazy=[select_notion_database_lazy],
     )
 
-    def _validate_send_to_notion_submission(state_values: dict) -> dict:
-        errors = {}
-        for block_id, action_id_to_value in state_values.items():
-            action_id = list(action_id_to_value.keys())[0]
-            value_obj = action_id_to_value[action_id]
-            str_value = value_obj.get("value")
-            if action_id == "number" and str_value is not None and not str_value.isnumeric():
-                errors[block_id] = "This property must be a number"
-            if action_id == "url" and str_value is not None and not str_value.startswith("http"):
-                errors[block_id] = "This property must be a URL"
-            if action_id == "email" and str_value is not None and "@" not in str_value:
-                errors[block_id] = "This property must be an email address"
-        return errors
-
     def sent_to_notion_ack(ack: Ack, view: dict):
-        errors = _validate_send_to_notion_submission(view["state"]["values"])
+        errors = validate_send_to_notion_submission(view["state"]["values"])
         if len(errors) > 0:
             ack(response_action="errors", errors=errors)
             return
+        record = notion_write_queue.idempotency_store.find(view_submission_key(view))
+        if record is not None and record.get("page_url") is not None and not is_batch_mode(view):
+            # Slack delivered this submission again after its page was created
+            record_ack_outcome(view, handled=True)
+            ack(
+                response_action="update",
+                view=build_message_view("send-to-notion-database", build_saved_message(record["page_url"])),
+            )
+            return
+        if reject_if_overloaded(ack, view):
+            return
+        record_ack_outcome(view, handled=False)
 
+        if is_batch_mode(view):
+            # The next row can be typed while this one is saved in the background
+            ack(response_action="update", view=build_next_row_view(view))
+            return
         ack(
             response_action="update",
-            view={
-                "type": "modal",
-                "callback_id": "send-to-notion-database",
-                "title": {"type": "plain_text", "text": "Send to Notion"},
-                "close": {"type": "plain_text", "text": "Close"},
-                "blocks": [
-                    {
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": ":hourglass: Wait a second. Now sending the data to Notion ...",
-                        },
-                    }
-                ],
-            },
+            view=build_message_view("send-to-notion-database", SENDING_DATA_MESSAGE),
         )
 
     def sent_to_notion_lazy(
@@ -251,52 +310,43 @@ def register_slack_event_handlers(app: App):
         client: WebClient,
         logger: logging.Logger,
     ):
-        errors = _validate_send_to_notion_submission(view["state"]["values"])
-        if len(errors) > 0:
+        errors = validate_send_to_notion_submission(view["state"]["values"])
+        if len(errors) > 0 or was_handled_in_ack(view):
             return
         try:
-            database_id = json.loads(view["private_metadata"])["notion_database_id"]
-            notion = Client(auth=resolve_notion_token(context))
-            new_page = send_to_notion(notion, database_id, view["state"]["values"])
-            page_url = new_page["url"]
-            client.views_update(
+            idempotency_key = view_submission_key(view)
+            if notion_write_queue.idempotency_store.claim(idempotency_key) is not None:
+                # The same submission has already been queued, and its write updates the modal
+                logger.info(f"Skipped a repeated submission (view: {view['id']})")
+                return
+            # The modal is updated with the page URL once a queue worker saves the data in Notion,
+            # or the summary is posted when the batch that this row belongs to is finished
+            batch_id = view_batch_id(view)
+            notion_write_queue.enqueue(
+                enterprise_id=context.enterprise_id,
+                team_id=context.team_id,
+                user_id=context.user_id,
                 view_id=view["id"],
-                view={
-                    "type": "modal",
-                    "callback_id": "send-to-notion-database",
-                    "title": {"type": "plain_text", "text": "Send to Notion"},
-                    "close": {"type": "plain_text", "text": "Close"},
-                    "blocks": [
-                        {
-                            "type": "section",
-                            "text": {
-                                "type": "mrkdwn",
-                                "text": f":white_check_mark: Your data has been successfully saved!\n\n{page_url}",
-                            },
-                        }
-                    ],
-                },
+                database_id=json.loads(view["private_metadata"])["notion_database_id"],
+                state_values=submitted_state_values(view),
+                message=json.loads(view["private_metadata"]).get("message"),
+                idempotency_key=idempotency_key,
+                batch_id=batch_id,
             )
+            if batch_id is not None and not is_batch_mode(view):
+                # The last row of the batch
+                notion_write_queue.close_batch(
+                    batch_id=batch_id,
+                    enterprise_id=context.enterprise_id,
+                    team_id=context.team_id,
+                    user_id=context.user_id,
+                    view_id=view["id"],
+                )
         except Exception as e:
             logger.exception(e)
             client.views_update(
                 view_id=view["id"],
-                view={
-                    "type": "modal",
-                    "callback_id": "send-to-notion-database",
-                    "title": {"type": "plain_text", "text": "Send to Notion"},
-                    "close": {"type": "plain_text", "text": "Close"},
-                    "blocks": [
-                        {
-                            "type": "section",
-                            "text": {
-                                "type": "mrkdwn",
-                                "text": ":x: Saving your data failed for some reason. "
-                                "Please contact this app's user support email address :bow:",
-                            },
-                        }
-                    ],
-                },
+                view=build_message_view("send-to-notion-database", SENDING_DATA_FAILED_MESSAGE),
             )
             say(
                 channel=context.user_id,
@@ -308,3 +358,48 @@ def register_slack_event_handlers(app: App):
         ack=sent_to_notion_ack,
         lazy=[sent_to_notion_lazy],
     )
+
+    @app.view_closed("send-to-notion-database")
+    def finish_batch_entry(ack: Ack, view: dict, context: BoltContext):
+        ack()
+        batch_id = json.loads(view["private_metadata"]).get("batch_id")
+        if batch_id is not None:
+            notion_write_queue.close_batch(
+                batch_id=batch_id,
+                enterprise_id=context.enterprise_id,
+                team_id=context.team_id,
+                user_id=context.user_id,
+            )
+
+    #
+    # Import CSV files
+    #
+
+    @app.shortcut("import-csv-to-notion")
+    def open_csv_import_form(ack: Ack, client: WebClient, body: dict):
+        ack()
+        message = body["message"]
+        file = find_csv_file(message)
+        if file is None:
+            view = build_message_view("import-csv-to-notion", NO_CSV_FILE_MESSAGE)
+        else:
+            view = build_csv_import_view(file, body["channel"]["id"], message.get("thread_ts", message["ts"]))
+        client.views_open(trigger_id=body["trigger_id"], view=view)
+
+    @app.view("import-csv-to-notion")
+    def start_csv_import(ack: Ack, view: dict, context: BoltContext):
+        ack(
+            response_action="update",
+            view=build_message_view("import-csv-to-notion", CSV_IMPORT_STARTED_MESSAGE),
+        )
+        metadata = json.loads(view["private_metadata"])
+        # The import runs in its own thread as it can take minutes for a large file
+        notion_csv_importer.start(
+            notion_token=resolve_notion_token(context),
+            bot_token=context.bot_token,
+            database_id=selected_database_id(view),
+            file=metadata["file"],
+            channel_id=metadata["channel_id"],
+            thread_ts=metadata["thread_ts"],
+            idempotency_key=view_submission_key(view),
+        )
@@ -0,0 +1,250 @@
+import html
+import logging
+import queue
+import re
+import threading
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from notion_client import Client
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from app.rate_limiter import TokenBucket, call_with_retries
+
+T = TypeVar("T")
+
+# Notion accepts up to 100 blocks per request, 100 rich text objects per block and 2000 characters per text object
+MAX_BLOCKS_PER_REQUEST = 100
+MAX_RICH_TEXTS_PER_BLOCK = 100
+MAX_TEXT_LENGTH = 2000
+
+UserNameResolver = Callable[[str], str]
+
+_INLINE_PATTERN = re.compile(
+    r"<(?P<angle>[^<>\n]+)>"
+    r"|`(?P<code>[^`\n]+)`"
+    r"|(?<![\w*])\*(?P<bold>[^*\s](?:[^*\n]*[^*\s])?)\*(?![\w*])"
+    r"|(?<![\w_])_(?P<italic>[^_\s](?:[^_\n]*[^_\s])?)_(?![\w_])"
+    r"|(?<![\w~])~(?P<strikethrough>[^~\s](?:[^~\n]*[^~\s])?)~(?![\w~])"
+)
+_BULLET_PATTERN = re.compile(r"^\s*[•◦▪\-*]\s+(.*)$")
+_NUMBERED_PATTERN = re.compile(r"^\s*\d+[.)]\s+(.*)$")
+
+
+def _text(content: str, link: Optional[str] = None, **annotations) -> Iterator[dict]:
+    for i in range(0, max(len(content), 1), MAX_TEXT_LENGTH):
+        rich_text = {"type": "text", "text": {"content": content[i : i + MAX_TEXT_LENGTH]}}
+        if link is not None:
+            rich_text["text"]["link"] = {"url": link}
+        if len(annotations) > 0:
+            rich_text["annotations"] = annotations
+        yield rich_text
+
+
+def _angle_to_rich_text(value: str, resolve_user_name: UserNameResolver) -> Iterator[dict]:
+    target, _, label = value.partition("|")
+    if target.startswith("@"):
+        yield from _text(f"@{label or resolve_user_name(target[1:])}", bold=True)
+    elif target.startswith("#"):
+        yield from _text(f"#{label or target[1:]}", bold=True)
+    elif target.startswith("!"):
+        # Special mentions such as <!here>, <!subteam^S123|@team> and <!date^...|fallback>
+        yield from _text(label or f"@{target[1:]}", bold=True)
+    else:
+        yield from _text(html.unescape(label or target), link=html.unescape(target))
+
+
+def mrkdwn_to_rich_text(text: str, resolve_user_name: UserNameResolver) -> List[dict]:
+    """Converts a line of Slack's mrkdwn into Notion rich text objects."""
+    rich_texts = []
+    position = 0
+    for match in _INLINE_PATTERN.finditer(text):
+        if match.start() > position:
+            rich_texts.extend(_text(html.unescape(text[position : match.start()])))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "angle":
+            rich_texts.extend(_angle_to_rich_text(value, resolve_user_name))
+        else:
+            rich_texts.extend(_text(html.unescape(value), **{kind: True}))
+        position = match.end()
+    if position < len(text):
+        rich_texts.extend(_text(html.unescape(text[position:])))
+    return rich_texts
+
+
+def _block(block_type: str, rich_texts: List[dict], **extra) -> Iterator[dict]:
+    for i in range(0, max(len(rich_texts), 1), MAX_RICH_TEXTS_PER_BLOCK):
+        yield {"type": block_type, block_type: {"rich_text": rich_texts[i : i + MAX_RICH_TEXTS_PER_BLOCK], **extra}}
+
+
+def mrkdwn_to_notion_blocks(text: str, resolve_user_name: UserNameResolver) -> Iterator[dict]:
+    """Converts Slack's mrkdwn into Notion blocks one by one.
+
+    Code blocks, quotes and bulleted and numbered lists become their Notion counterparts,
+    and consecutive plain lines become a single paragraph.
+    """
+    # Every other segment is inside ``` ... ```
+    for index, segment in enumerate(text.split("```")):
+        if index % 2 == 1:
+            code = html.unescape(segment.strip("\n"))
+            if len(code) > 0:
+                yield from _block("code", list(_text(code)), language="plain text")
+            continue
+
+        paragraph: List[str] = []
+        for line in segment.split("\n"):
+            bullet = _BULLET_PATTERN.match(line)
+            numbered = _NUMBERED_PATTERN.match(line)
+            if line.startswith("&gt;") or bullet is not None or numbered is not None or len(line.strip()) == 0:
+                if len(paragraph) > 0:
+                    yield from _block("paragraph", mrkdwn_to_rich_text("\n".join(paragraph), resolve_user_name))
+                    paragraph = []
+            if line.startswith("&gt;"):
+                yield from _block("quote", mrkdwn_to_rich_text(line[4:].lstrip(), resolve_user_name))
+            elif bullet is not None:
+                yield from _block("bulleted_list_item", mrkdwn_to_rich_text(bullet.group(1), resolve_user_name))
+            elif numbered is not None:
+                yield from _block("numbered_list_item", mrkdwn_to_rich_text(numbered.group(1), resolve_user_name))
+            elif len(line.strip()) > 0:
+                paragraph.append(line)
+        if len(paragraph) > 0:
+            yield from _block("paragraph", mrkdwn_to_rich_text("\n".join(paragraph), resolve_user_name))
+
+
+def message_to_notion_blocks(message: dict, resolve_user_name: UserNameResolver, with_header: bool) -> Iterator[dict]:
+    if with_header:
+        author = message.get("user_profile", {}).get("real_name") or message.get("username")
+        if author is None and message.get("user") is not None:
+            author = resolve_user_name(message["user"])
+        sent_at = datetime.fromtimestamp(float(message["ts"]), timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+        yield from _block(
+            "paragraph",
+            list(_text(author or "Unknown", bold=True)) + list(_text(f"  {sent_at}", color="gray")),
+        )
+    text = message.get("text") or "\n".join(a.get("fallback", "") for a in message.get("attachments", []))
+    yield from mrkdwn_to_notion_blocks(text, resolve_user_name)
+    for file in message.get("files", []):
+        yield from _block("paragraph", list(_text(file.get("name") or "Attached file", link=file.get("permalink"))))
+
+
+def suggest_page_title(message: dict, max_length: int = 150) -> str:
+    """Returns the first line of a message as plain text, to be used as the initial value of a page title."""
+    first_line = (message.get("text") or "").strip().split("\n")[0]
+    plain = "".join(t["text"]["content"] for t in mrkdwn_to_rich_text(first_line, lambda user_id: user_id))
+    return plain[:max_length]
+
+
+def iter_slack_messages(client: WebClient, channel_id: str, ts: str, thread_ts: Optional[str], whole_thread: bool):
+    """Yields the message, or all the messages in its thread, reading conversations.replies page by page."""
+    cursor = None
+    while True:
+        response = client.conversations_replies(channel=channel_id, ts=thread_ts or ts, cursor=cursor, limit=200)
+        for message in response["messages"]:
+            if whole_thread:
+                yield message
+            elif message["ts"] == ts:
+                yield message
+                return
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+def iter_message_export_blocks(client: WebClient, source: dict, logger: logging.Logger) -> Iterator[dict]:
+    """Yields the Notion blocks that copy a Slack message or thread, starting with a link to it.
+
+    source is the message's channel_id, ts, thread_ts and whether the whole thread is exported.
+    A failure to read Slack is written into the page instead of failing the page creation.
+    The client is expected to retry rate-limited calls after Retry-After, as long threads take many calls.
+    """
+    user_names: Dict[str, str] = {}
+
+    def resolve_user_name(user_id: str) -> str:
+        if user_id not in user_names:
+            try:
+                profile = client.users_info(user=user_id)["user"].get("profile", {})
+                user_names[user_id] = profile.get("display_name") or profile.get("real_name") or user_id
+            except SlackApiError:
+                user_names[user_id] = user_id
+        return user_names[user_id]
+
+    try:
+        permalink = client.chat_getPermalink(channel=source["channel_id"], message_ts=source["ts"])["permalink"]
+        yield from _block("paragraph", list(_text("Open in Slack", link=permalink)))
+        messages = iter_slack_messages(
+            client, source["channel_id"], source["ts"], source.get("thread_ts"), source.get("whole_thread", False)
+        )
+        for message in messages:
+            yield from message_to_notion_blocks(message, resolve_user_name, with_header=source.get("whole_thread", False))
+    except SlackApiError as e:
+        logger.warning(f"Failed to read the Slack messages to copy into Notion (error: {e.response['error']})")
+        error = e.response["error"]
+        hint = " Please invite this app to the channel." if error in ("not_in_channel", "channel_not_found") else ""
+        yield from _block("paragraph", list(_text(f"Failed to copy the Slack messages ({error}).{hint}", italic=True)))
+
+
+def iter_in_background(items: Iterable[T], max_buffered: int = 500) -> Iterator[T]:
+    """Iterates items in another thread, so that producing the next items overlaps with the consumer's work."""
+    buffer: "queue.Queue" = queue.Queue(maxsize=max_buffered)
+    stopped = threading.Event()
+    end = object()
+
+    def put(entry: tuple) -> bool:
+        # Gives up when the consumer has stopped, instead of blocking forever on a full buffer
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    threading.Thread(target=produce, name="iter-in-background", daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def take_batch(blocks: Iterator[dict], size: int = MAX_BLOCKS_PER_REQUEST) -> List[dict]:
+    return list(islice(blocks, size))
+
+
+def append_notion_blocks(
+    notion: Client,
+    block_id: str,
+    blocks: Iterator[dict],
+    limiter: TokenBucket,
+    max_attempts: int = 5,
+) -> int:
+    """Appends blocks to a page in batches of 100 under the rate limit, and returns how many were appended.
+
+    Batches go one at a time because Notion appends them in the order of the requests.
+    """
+    appended = 0
+    while True:
+        batch = take_batch(blocks)
+        if len(batch) == 0:
+            return appended
+        call_with_retries(
+            lambda batch=batch: notion.blocks.children.append(block_id=block_id, children=batch), limiter, max_attempts
+        )
+        appended += len(batch)
@@ -0,0 +1,50 @@
+import threading
+import time
+from typing import Dict, Optional
+
+from app.shared_store import SharedStore
+
+
+class SlackNotionUserIndex:
+    """Maps Slack user IDs to Notion user IDs by their email addresses.
+
+    It is rebuilt in the background by app.notion_ops so that converting a people property's
+    selected Slack users to Notion users is a dict lookup instead of Slack and Notion API calls.
+    """
+
+    def __init__(self, store: Optional[SharedStore] = None, store_key: str = "users"):
+        self.store = store if store is not None else SharedStore()
+        self.store_key = store_key
+        self._notion_user_ids: Dict[str, str] = {}
+        self._synced_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._synced_at is not None
+
+    def __len__(self) -> int:
+        return len(self._notion_user_ids)
+
+    def replace_all(self, slack_user_emails: Dict[str, str], notion_user_ids_by_email: Dict[str, str]) -> None:
+        notion_user_ids = {}
+        for slack_user_id, email in slack_user_emails.items():
+            notion_user_id = notion_user_ids_by_email.get(email.lower())
+            if notion_user_id is not None:
+                notion_user_ids[slack_user_id] = notion_user_id
+        with self._lock:
+            self._notion_user_ids = notion_user_ids
+            self._synced_at = time.time()
+        self.store.put(self.store_key, {"notion_user_ids": notion_user_ids, "synced_at": self._synced_at})
+
+    def load_snapshot(self) -> None:
+        """Starts from the index that the last sync saved in the store, until the next sync finishes."""
+        snapshot = self.store.get(self.store_key)
+        with self._lock:
+            if snapshot is None or (self._synced_at is not None and snapshot["synced_at"] <= self._synced_at):
+                return
+            self._notion_user_ids = snapshot["notion_user_ids"]
+            self._synced_at = snapshot["synced_at"]
+
+    def get(self, slack_user_id: str) -> Optional[str]:
+        return self._notion_user_ids.get(slack_user_id)
@@ -0,0 +1,293 @@
+import copy
+import json
+from typing import List, Dict, Any, Optional
+
+from app.notion_ops import MAX_MODAL_BLOCKS, strip_generation, with_generation
+from app.slack_message_export import suggest_page_title
+
+BATCH_MODE_BLOCK_ID = "batch-mode"
+_BATCH_MODE_OPTION = {"text": {"type": "plain_text", "text": "Keep this form open to add another row"}, "value": "on"}
+
+
+def build_home_view() -> dict:
+    return {
+        "type": "home",
+        "blocks": [
+            {
+                "type": "section",
+                "block_id": "header",
+                "text": {"type": "mrkdwn", "text": "*Welcome to Send to Notion in Slack* :raised_hands:"},
+            },
+            {
+                "type": "actions",
+                "block_id": "open-modal-button",
+                "elements": [
+                    {
+                        "type": "button",
+                        "text": {"type": "plain_text", "text": "Submit data to Notion"},
+                        "value": "clicked",
+                        "action_id": "open-notion-form",
+                    }
+                ],
+            },
+        ],
+    }
+
+
+def build_database_selection_view(message: Optional[dict] = None) -> dict:
+    """Builds the first modal. message is the Slack message to copy into the new page, when opened from its shortcut."""
+    blocks = [
+        {
+            "type": "input",
+            "block_id": "search-notion-database",
+            "element": {
+                "type": "external_select",
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "Find a Notion database",
+                },
+                "action_id": "search-notion-database",
+                "min_query_length": 0,
+            },
+            "label": {"type": "plain_text", "text": "Notion Database"},
+        }
+    ]
+    if message is not None and message.get("in_thread"):
+        options = [
+            {"text": {"type": "plain_text", "text": "This message"}, "value": "message"},
+            {"text": {"type": "plain_text", "text": "The whole thread"}, "value": "thread"},
+        ]
+        blocks.append(
+            {
+                "type": "input",
+                "block_id": "message-scope",
+                "element": {
+                    "type": "radio_buttons",
+                    "action_id": "message-scope",
+                    "options": options,
+                    "initial_option": options[1] if message.get("whole_thread") else options[0],
+                },
+                "label": {"type": "plain_text", "text": "Copy into the page"},
+            }
+        )
+
+    view = {
+        "type": "modal",
+        "callback_id": "select-notion-database",
+        "title": {"type": "plain_text", "text": "Send to Notion"},
+        "submit": {"type": "plain_text", "text": "Next"},
+        "close": {"type": "plain_text", "text": "Close"},
+        "blocks": blocks,
+    }
+    if message is not None:
+        view["private_metadata"] = json.dumps({"message": message})
+    return view
+
+
+def build_message_source(channel_id: str, message: dict) -> dict:
+    """Returns what the write queue needs to copy a Slack message, along with a suggested page title."""
+    return {
+        "channel_id": channel_id,
+        "ts": message["ts"],
+        "thread_ts": message.get("thread_ts"),
+        "in_thread": message.get("thread_ts") is not None or message.get("reply_count", 0) > 0,
+        "whole_thread": False,
+        "title": suggest_page_title(message),
+    }
+
+
+def selected_message_source(view: dict) -> Optional[dict]:
+    """Returns the Slack message to copy into the new page, with the choice of copying its thread applied."""
+    if not view.get("private_metadata"):
+        return None
+    message = json.loads(view["private_metadata"]).get("message")
+    scope = view.get("state", {}).get("values", {}).get("message-scope", {}).get("message-scope")
+    if message is not None and scope is not None and scope.get("selected_option") is not None:
+        message["whole_thread"] = scope["selected_option"]["value"] == "thread"
+    return message
+
+
+def build_csv_import_view(file: dict, channel_id: str, thread_ts: str) -> dict:
+    view = build_database_selection_view()
+    view["callback_id"] = "import-csv-to-notion"
+    view["submit"] = {"type": "plain_text", "text": "Import"}
+    view["blocks"].insert(
+        0,
+        {
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": f"Every row in *{file.get('name', 'the CSV file')}* will be sent to:"},
+        },
+    )
+    file = {k: file.get(k) for k in ("id", "name", "url_private_download")}
+    view["private_metadata"] = json.dumps({"file": file, "channel_id": channel_id, "thread_ts": thread_ts})
+    return view
+
+
+def find_csv_file(message: dict) -> Optional[dict]:
+    for file in message.get("files", []):
+        if file.get("filetype") == "csv" or file.get("name", "").lower().endswith(".csv"):
+            return file
+    return None
+
+
+def build_message_view(callback_id: str, text: str) -> dict:
+    return {
+        "type": "modal",
+        "callback_id": callback_id,
+        "title": {"type": "plain_text", "text": "Send to Notion"},
+        "close": {"type": "plain_text", "text": "Close"},
+        "blocks": [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": text,
+                },
+            }
+        ],
+    }
+
+
+def build_send_to_notion_view(database_id: str, blocks: List[Dict[str, Any]], message: Optional[dict] = None) -> dict:
+    metadata: Dict[str, Any] = {"notion_database_id": database_id}
+    if message is not None:
+        metadata["message"] = message
+        # The blocks are shared by every user of the cached form, so prefill the title on a copy
+        blocks = copy.deepcopy(blocks)
+        for block in blocks:
+            if block.get("element", {}).get("action_id") == "title" and message.get("title"):
+                block["element"]["initial_value"] = message["title"]
+    elif len(blocks) < MAX_MODAL_BLOCKS:
+        # A copied Slack message makes a single page, so batch entry is offered only without one
+        blocks = blocks + [_build_batch_mode_block(checked=False)]
+    return {
+        "type": "modal",
+        "callback_id": "send-to-notion-database",
+        "title": {"type": "plain_text", "text": "Send to Notion"},
+        "submit": {"type": "plain_text", "text": "Submit"},
+        "close": {"type": "plain_text", "text": "Close"},
+        "private_metadata": json.dumps(metadata),
+        "blocks": blocks,
+    }
+
+
+def _build_batch_mode_block(checked: bool, hint: Optional[str] = None) -> dict:
+    element: Dict[str, Any] = {"type": "checkboxes", "action_id": BATCH_MODE_BLOCK_ID, "options": [_BATCH_MODE_OPTION]}
+    if checked:
+        element["initial_options"] = [_BATCH_MODE_OPTION]
+    block = {
+        "type": "input",
+        "block_id": BATCH_MODE_BLOCK_ID,
+        "element": element,
+        "label": {"type": "plain_text", "text": "Batch entry"},
+        "optional": True,
+    }
+    if hint is not None:
+        block["hint"] = {"type": "plain_text", "text": hint}
+    return block
+
+
+def is_batch_mode(view: dict) -> bool:
+    selected = view["state"]["values"].get(BATCH_MODE_BLOCK_ID, {}).get(BATCH_MODE_BLOCK_ID, {}).get("selected_options")
+    return selected is not None and len(selected) > 0
+
+
+def view_batch_id(view: dict) -> Optional[str]:
+    """Returns the batch that the submitted row belongs to, or None when it's not part of a batch entry."""
+    batch_id = json.loads(view["private_metadata"]).get("batch_id")
+    if batch_id is None and is_batch_mode(view):
+        # The first row of a batch
+        batch_id = view_submission_key(view)
+    return batch_id
+
+
+def build_next_row_view(view: dict) -> dict:
+    """Builds the submitted form again with empty inputs, so that the next row of a batch entry can be typed.
+
+    Slack keeps what was typed into an input as long as its block_id stays the same, so the
+    property inputs get block_ids with a new generation suffix, which submitted_state_values strips.
+    """
+    metadata = json.loads(view["private_metadata"])
+    generation = metadata.get("generation", 0)
+    metadata["batch_id"] = view_batch_id(view)
+    metadata["generation"] = generation + 1
+    metadata["rows"] = metadata.get("rows", 0) + 1
+    hint = f"{metadata['rows']} rows sent so far. Uncheck this for the last row, or close the form when you're done."
+    blocks = []
+    for block in view["blocks"]:
+        if block.get("block_id") == BATCH_MODE_BLOCK_ID:
+            blocks.append(_build_batch_mode_block(checked=True, hint=hint))
+            continue
+        block = copy.deepcopy(block)
+        if block["type"] == "input":
+            block["block_id"] = with_generation(block["block_id"], generation + 1)
+        blocks.append(block)
+    return {
+        "type": "modal",
+        "callback_id": "send-to-notion-database",
+        "title": {"type": "plain_text", "text": "Send to Notion"},
+        "submit": {"type": "plain_text", "text": "Submit"},
+        "close": {"type": "plain_text", "text": "Done"},
+        # Closing the form ends the batch entry, and then the summary is posted
+        "notify_on_close": True,
+        "private_metadata": json.dumps(metadata),
+        "blocks": blocks,
+    }
+
+
+def submitted_state_values(view: dict) -> dict:
+    """Returns the submitted values keyed by the Notion property ids, as to_page_properties expects."""
+    return {
+        strip_generation(block_id): value
+        for block_id, value in view["state"]["values"].items()
+        if block_id != BATCH_MODE_BLOCK_ID
+    }
+
+
+def view_submission_key(view: dict) -> str:
+    """Identifies a view submission. Slack sends the same view id and hash when it delivers a submission again."""
+    return f"view:{view['id']}:{view['hash']}"
+
+
+def selected_database_id(view: dict) -> str:
+    block_key = "search-notion-database"
+    return view["state"]["values"][block_key][block_key]["selected_option"]["value"]
+
+
+def validate_send_to_notion_submission(state_values: dict) -> dict:
+    errors = {}
+    for block_id, action_id_to_value in state_values.items():
+        action_id = list(action_id_to_value.keys())[0]
+        value_obj = action_id_to_value[action_id]
+        str_value = value_obj.get("value")
+        if action_id == "number" and str_value is not None and not str_value.isnumeric():
+            errors[block_id] = "This property must be a number"
+        if action_id == "url" and str_value is not None and not str_value.startswith("http"):
+            errors[block_id] = "This property must be a URL"
+        if action_id == "email" and str_value is not None and "@" not in str_value:
+            errors[block_id] = "This property must be an email address"
+    return errors
+
+
+LOADING_DATABASE_MESSAGE = ":hourglass: Wait a second. Now loading the database ..."
+LOADING_DATABASE_FAILED_MESSAGE = (
+    ":x: Loading Notion database data failed for some reason. Please contact this app's user support email address :bow:"
+)
+SENDING_DATA_MESSAGE = ":hourglass: Wait a second. Now sending the data to Notion ..."
+SENDING_DATA_FAILED_MESSAGE = (
+    ":x: Saving your data failed for some reason. Please contact this app's user support email address :bow:"
+)
+BUSY_MESSAGE = "This app is busy right now. Please submit again in a few seconds."
+NO_CSV_FILE_MESSAGE = ":warning: Please run this shortcut on a message with a CSV file."
+CSV_IMPORT_STARTED_MESSAGE = ":hourglass: Started importing the CSV file. The progress will be posted in the thread."
+
+
+def build_saved_message(page_url: str) -> str:
+    return f":white_check_mark: Your data has been successfully saved!\n\n{page_url}"
+
+
+def build_batch_summary_message(page_urls: List[str], errors: List[str]) -> str:
+    lines = [f":white_check_mark: {len(page_urls)} rows have been successfully saved!", ""] + page_urls
+    if len(errors) > 0:
+        lines += ["", f":x: {len(errors)} rows failed to be saved:"] + errors
+    return "\n".join(lines)
@@ -0,0 +1,26 @@
+# Runs this app in HTTP mode with a multi-process ASGI server, for example:
+#
+# pip install uvicorn
+# uvicorn --workers 4 --host 0.0.0.0 --port 3000 asgi:application
+#
+import asyncio
+from urllib.parse import parse_qsl
+
+from slack_bolt.adapter.asgi.async_handler import AsyncSlackRequestHandler
+
+from main import configure_logging, create_async_app, notion_oauth_flow, start_background_jobs
+
+configure_logging()
+slack_request_handler = AsyncSlackRequestHandler(create_async_app(start_background_jobs()))
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and notion_oauth_flow is not None and scope["path"] == notion_oauth_flow.redirect_uri_path:
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("utf-8")))
+        # The token exchange uses a blocking HTTP client
+        status, text = await asyncio.to_thread(notion_oauth_flow.handle_callback, params)
+        headers = [(b"content-type", b"text/plain;charset=utf-8")]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": text.encode("utf-8")})
+        return
+    await slack_request_handler(scope, receive, send)
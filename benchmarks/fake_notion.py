@@ -0,0 +1,146 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+
+def build_database(database_id: str, title: str, options: int = 20) -> dict:
+    return {
+        "object": "database",
+        "id": database_id,
+        "title": [{"type": "text", "plain_text": title, "text": {"content": title}}],
+        "last_edited_time": "2023-01-01T00:00:00.000Z",
+        "properties": {
+            "Name": {"id": "title", "type": "title", "title": {}},
+            "Description": {"id": "desc", "type": "rich_text", "rich_text": {}},
+            "Points": {"id": "pts", "type": "number", "number": {}},
+            "Due": {"id": "due", "type": "date", "date": {}},
+            "Done": {"id": "done", "type": "checkbox", "checkbox": {}},
+            "Status": {
+                "id": "stat",
+                "type": "select",
+                "select": {"options": [{"id": f"s{i}", "name": f"Status {i}"} for i in range(5)]},
+            },
+            "Tags": {
+                "id": "tags",
+                "type": "multi_select",
+                "multi_select": {"options": [{"id": f"t{i}", "name": f"Tag {i}"} for i in range(options)]},
+            },
+        },
+    }
+
+
+class FakeNotionServer:
+    """A local stand-in for the Notion API endpoints this app uses, with configurable latency and 429 responses."""
+
+    def __init__(
+        self,
+        databases: int = 200,
+        latency_seconds: float = 0.1,
+        jitter: float = 0.5,
+        rate_limited_ratio: float = 0.0,
+        retry_after_seconds: float = 1,
+    ):
+        self.latency_seconds = latency_seconds
+        self.jitter = jitter
+        self.rate_limited_ratio = rate_limited_ratio
+        self.retry_after_seconds = retry_after_seconds
+        self.databases: Dict[str, dict] = {}
+        for i in range(databases):
+            database_id = str(uuid.UUID(int=i + 1))
+            self.databases[database_id] = build_database(database_id, f"Benchmark database {i}")
+        self.requests: Dict[str, int] = {}
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._build_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeNotionServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def handle(self, method: str, path: str, body: dict):
+        """Returns the status code, headers and JSON body for a request."""
+        endpoint = re.sub(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", "{id}", path)
+        with self._lock:
+            self.requests[f"{method} {endpoint}"] = self.requests.get(f"{method} {endpoint}", 0) + 1
+            rate_limited = random.random() < self.rate_limited_ratio
+            if rate_limited:
+                self.rate_limited += 1
+        time.sleep(self.latency_seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if rate_limited:
+            error = {"object": "error", "status": 429, "code": "rate_limited", "message": "Rate limited"}
+            return 429, {"Retry-After": str(self.retry_after_seconds)}, error
+
+        if method == "POST" and endpoint == "/v1/search":
+            return 200, {}, self._paginate(list(self.databases.values()), body)
+        if method == "GET" and endpoint == "/v1/databases/{id}":
+            database = self.databases.get(path.split("/")[3])
+            if database is None:
+                return 404, {}, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"}
+            return 200, {}, database
+        if method == "POST" and endpoint == "/v1/databases/{id}/query":
+            return 200, {}, self._paginate([], body)
+        if method == "POST" and endpoint == "/v1/pages":
+            page_id = str(uuid.uuid4())
+            return 200, {}, {"object": "page", "id": page_id, "url": f"https://www.notion.so/{page_id.replace('-', '')}"}
+        if method == "GET" and endpoint == "/v1/users":
+            return 200, {}, self._paginate([], body)
+        return 400, {}, {"object": "error", "status": 400, "code": "invalid_request_url", "message": path}
+
+    @staticmethod
+    def _paginate(results: List[dict], body: dict) -> dict:
+        start = int(body.get("start_cursor") or 0)
+        size = int(body.get("page_size") or 100)
+        next_cursor = str(start + size) if start + size < len(results) else None
+        return {
+            "object": "list",
+            "results": results[start : start + size],
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        }
+
+    def _build_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length > 0 else b""
+                body = json.loads(raw) if len(raw) > 0 else {}
+                path, _, query = self.path.partition("?")
+                for pair in query.split("&"):
+                    if "=" in pair:
+                        key, value = pair.split("=", 1)
+                        body.setdefault(key, value)
+                status, headers, response = fake.handle(self.command, path, body)
+                out = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = _respond
+            do_POST = _respond
+            do_PATCH = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
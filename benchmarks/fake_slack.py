@@ -0,0 +1,107 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+
+class FakeSlackServer:
+    """A local stand-in for the Slack Web API with configurable latency.
+
+    Every views.* call is recorded with the time it arrived, so that a benchmark can measure
+    how long it takes until a modal shows its final view.
+    """
+
+    def __init__(self, latency_seconds: float = 0.05, jitter: float = 0.5):
+        self.latency_seconds = latency_seconds
+        self.jitter = jitter
+        self.requests: Dict[str, int] = {}
+        # view_id -> [(arrived_at, view)]
+        self._views: Dict[str, List[tuple]] = {}
+        self._condition = threading.Condition()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._build_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api/"
+
+    def start(self) -> "FakeSlackServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def wait_for_view(
+        self,
+        view_id: str,
+        predicate: Callable[[dict], bool],
+        timeout: float,
+    ) -> Optional[float]:
+        """Waits for a views.* call for the view that matches the predicate and returns the time it arrived."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                for arrived_at, view in self._views.get(view_id, []):
+                    if predicate(view):
+                        return arrived_at
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def handle(self, api_method: str, params: dict) -> dict:
+        with self._condition:
+            self.requests[api_method] = self.requests.get(api_method, 0) + 1
+        time.sleep(self.latency_seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if api_method in ("views.update", "views.open", "views.push"):
+            view = params.get("view")
+            if isinstance(view, str):
+                view = json.loads(view)
+            view_id = params.get("view_id") or params.get("trigger_id")
+            with self._condition:
+                self._views.setdefault(view_id, []).append((time.monotonic(), view))
+                self._condition.notify_all()
+            return {"ok": True, "view": dict(view, id=view_id)}
+        if api_method == "auth.test":
+            return {
+                "ok": True,
+                "team_id": "T0000",
+                "user_id": "U0000",
+                "bot_id": "B0000",
+                "url": "https://example.slack.com/",
+            }
+        if api_method in ("chat.postMessage", "chat.update"):
+            return {"ok": True, "channel": params.get("channel"), "ts": f"{time.time():.6f}"}
+        if api_method == "users.list":
+            return {"ok": True, "members": [], "response_metadata": {"next_cursor": ""}}
+        return {"ok": True}
+
+    def _build_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length).decode("utf-8") if length > 0 else ""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(raw) if len(raw) > 0 else {}
+                else:
+                    params = dict(parse_qsl(raw))
+                response = fake.handle(self.path.rsplit("/", 1)[-1], params)
+                out = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,345 @@
+"""Replays Slack payloads against the app wired to local stand-ins for the Slack and Notion APIs.
+
+    python -m benchmarks.run --flows options,select,submit,shortcut --rate 20 --duration 10 --notion-latency-ms 150
+
+Payloads are dispatched the same way the Socket Mode adapter does, so the numbers cover everything
+from Bolt's dispatch to the Slack and Notion API calls, but not the WebSocket connection itself.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from slack_bolt import App, BoltContext, BoltRequest
+from slack_sdk import WebClient
+
+from app.listener_executor import LazyListenerExecutor
+from app.metrics import Metrics, InstrumentedWebClient
+from app.notion_caches import NotionCachesRegistry
+from app.notion_clients import NotionClientRegistry
+from app.notion_csv_import import NotionCsvImporter
+from app.notion_write_queue import NotionWriteQueue
+from app.rate_limiter import TokenBucketRegistry
+from app.slack_events import register_slack_event_handlers
+from benchmarks.fake_notion import FakeNotionServer
+from benchmarks.fake_slack import FakeSlackServer
+
+TEAM_ID = "T0000"
+NOTION_TOKEN = "secret_benchmark"
+
+# A flow builds a payload and returns it with a predicate that tells whether a views.* call shows the final view
+Flow = Callable[[int], Tuple[dict, Optional[str], Optional[Callable[[dict], bool]]]]
+
+
+class FlowStats:
+    def __init__(self):
+        self.ack_seconds: List[float] = []
+        self.final_seconds: List[float] = []
+        self.errors = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, ack_seconds: Optional[float], final_seconds: Optional[float], timed_out: bool) -> None:
+        with self._lock:
+            if ack_seconds is None:
+                self.errors += 1
+                return
+            self.ack_seconds.append(ack_seconds)
+            if final_seconds is not None:
+                self.final_seconds.append(final_seconds)
+            if timed_out:
+                self.timeouts += 1
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.notion = FakeNotionServer(
+            databases=args.databases,
+            latency_seconds=args.notion_latency_ms / 1000,
+            rate_limited_ratio=args.notion_rate_limited_ratio,
+        ).start()
+        self.slack = FakeSlackServer(latency_seconds=args.slack_latency_ms / 1000).start()
+        self.database_ids = list(self.notion.databases.keys())
+        self.metrics = Metrics()
+        self._queue_dir = tempfile.TemporaryDirectory()
+        self.app, self.listener_executor, self.write_queue = self._build_app()
+
+    def _build_app(self) -> Tuple[App, LazyListenerExecutor, NotionWriteQueue]:
+        # The same wiring as main.create_app() except for the API base URLs
+        args = self.args
+        notion_caches = NotionCachesRegistry()
+        notion_clients = NotionClientRegistry(base_url=self.notion.base_url, metrics=self.metrics)
+        rate_limiters = TokenBucketRegistry(rate_per_second=args.notion_writes_per_second)
+        slack_client = InstrumentedWebClient(token="xoxb-benchmark", base_url=self.slack.base_url, metrics=self.metrics)
+        write_queue = NotionWriteQueue(
+            path=os.path.join(self._queue_dir.name, "notion_write_queue.sqlite3"),
+            notion_clients=notion_clients,
+            notion_caches=notion_caches,
+            resolve_notion_token=lambda enterprise_id, team_id: NOTION_TOKEN,
+            resolve_slack_client=lambda enterprise_id, team_id: slack_client,
+            rate_limiters=rate_limiters,
+            workers=args.notion_write_workers,
+        )
+        csv_importer = NotionCsvImporter(notion_clients, notion_caches, rate_limiters)
+        listener_executor = LazyListenerExecutor(
+            max_workers=args.lazy_listener_workers,
+            overload_policy=args.lazy_listener_overload_policy,
+            metrics=self.metrics,
+        )
+        app = App(
+            client=WebClient(token="xoxb-benchmark", base_url=self.slack.base_url),
+            listener_executor=listener_executor,
+        )
+
+        @app.middleware
+        def attach_notion_token(context: BoltContext, next_: Callable):
+            context["notion_token"] = NOTION_TOKEN
+            next_()
+
+        register_slack_event_handlers(
+            app,
+            notion_clients,
+            notion_caches,
+            write_queue,
+            csv_importer,
+            rate_limiters,
+            listener_executor=listener_executor,
+            schema_prefetch_size=args.schema_prefetch_size,
+            metrics=self.metrics,
+        )
+        return app, listener_executor, write_queue
+
+    #
+    # Flows
+    #
+
+    @staticmethod
+    def _user(i: int) -> dict:
+        return {"id": f"U{i % 50:04d}", "team_id": TEAM_ID}
+
+    def options_flow(self, i: int):
+        payload = {
+            "type": "block_suggestion",
+            "team": {"id": TEAM_ID},
+            "user": self._user(i),
+            "api_app_id": "A0000",
+            "action_id": "search-notion-database",
+            "block_id": "search-notion-database",
+            "value": random.choice(["", "bench", "database 1", "database 4", "9"]),
+            "view": {"id": f"V{i}", "type": "modal", "callback_id": "select-notion-database"},
+        }
+        return payload, None, None
+
+    def select_flow(self, i: int):
+        view_id = f"VS{i}"
+        # Users mostly pick one of the first few results, which the options handler prefetches
+        database_id = self.database_ids[min(int(random.expovariate(0.5)), len(self.database_ids) - 1)]
+        payload = {
+            "type": "view_submission",
+            "team": {"id": TEAM_ID},
+            "user": self._user(i),
+            "api_app_id": "A0000",
+            "view": {
+                "id": view_id,
+                "hash": uuid.uuid4().hex,
+                "type": "modal",
+                "callback_id": "select-notion-database",
+                "state": {
+                    "values": {
+                        "search-notion-database": {
+                            "search-notion-database": {
+                                "type": "external_select",
+                                "selected_option": {"text": {"type": "plain_text", "text": "x"}, "value": database_id},
+                            }
+                        }
+                    }
+                },
+            },
+        }
+        return payload, view_id, lambda view: view.get("callback_id") == "send-to-notion-database"
+
+    def submit_flow(self, i: int):
+        view_id = f"VW{i}"
+        payload = {
+            "type": "view_submission",
+            "team": {"id": TEAM_ID},
+            "user": self._user(i),
+            "api_app_id": "A0000",
+            "view": {
+                "id": view_id,
+                "hash": uuid.uuid4().hex,
+                "type": "modal",
+                "callback_id": "send-to-notion-database",
+                "private_metadata": json.dumps({"notion_database_id": random.choice(self.database_ids)}),
+                "state": {
+                    "values": {
+                        "title": {"title": {"type": "plain_text_input", "value": f"Benchmark row {i}"}},
+                        "desc": {"rich_text": {"type": "plain_text_input", "value": "Created by the benchmark"}},
+                        "pts": {"number": {"type": "plain_text_input", "value": str(i % 13)}},
+                        "stat": {"select": {"type": "static_select", "selected_option": {"value": "s1"}}},
+                    }
+                },
+            },
+        }
+        return payload, view_id, lambda view: ":white_check_mark:" in json.dumps(view.get("blocks", []))
+
+    def shortcut_flow(self, i: int):
+        trigger_id = f"{i}.{uuid.uuid4().hex}"
+        payload = {
+            "type": "shortcut",
+            "team": {"id": TEAM_ID},
+            "user": self._user(i),
+            "api_app_id": "A0000",
+            "callback_id": "open-notion-form",
+            "trigger_id": trigger_id,
+        }
+        return payload, trigger_id, lambda view: view.get("callback_id") == "select-notion-database"
+
+    #
+    # Runner
+    #
+
+    def dispatch(self, payload: dict):
+        return self.app.dispatch(BoltRequest(body=payload, mode="socket_mode"))
+
+    def run_flow(self, name: str, flow: Flow) -> Dict[str, object]:
+        stats = FlowStats()
+        rate = self.args.rate
+        total = int(rate * self.args.duration)
+
+        def run_once(i: int):
+            payload, view_id, is_final_view = flow(i)
+            started_at = time.monotonic()
+            try:
+                response = self.dispatch(payload)
+            except Exception:
+                stats.record(None, None, False)
+                return
+            acked_at = time.monotonic()
+            if response.status != 200:
+                stats.record(None, None, False)
+                return
+            if view_id is None:
+                stats.record(acked_at - started_at, None, False)
+                return
+            # The ack itself may already respond with the final view
+            if response.body and is_final_view(json.loads(response.body).get("view", {})):
+                stats.record(acked_at - started_at, acked_at - started_at, False)
+                return
+            shown_at = self.slack.wait_for_view(view_id, is_final_view, timeout=self.args.final_view_timeout)
+            stats.record(acked_at - started_at, None if shown_at is None else shown_at - started_at, shown_at is None)
+
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency, thread_name_prefix=f"benchmark-{name}") as executor:
+            # Open-loop load: requests are sent on schedule regardless of how long the previous ones take
+            for i in range(total):
+                delay = started_at + i / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(run_once, i)
+            sent_at = time.monotonic()
+        finished_at = time.monotonic()
+
+        return {
+            "flow": name,
+            "requests": total,
+            "errors": stats.errors,
+            "timeouts": stats.timeouts,
+            "sent_per_second": total / max(sent_at - started_at, 1e-9),
+            "completed_per_second": (total - stats.errors) / max(finished_at - started_at, 1e-9),
+            "ack_p50_ms": _ms(percentile(stats.ack_seconds, 50)),
+            "ack_p99_ms": _ms(percentile(stats.ack_seconds, 99)),
+            "final_view_p50_ms": _ms(percentile(stats.final_seconds, 50)),
+            "final_view_p99_ms": _ms(percentile(stats.final_seconds, 99)),
+        }
+
+    def run(self) -> List[Dict[str, object]]:
+        flows = {
+            "options": self.options_flow,
+            "select": self.select_flow,
+            "submit": self.submit_flow,
+            "shortcut": self.shortcut_flow,
+        }
+        self.write_queue.start()
+        try:
+            # Loads the database directory, which only the very first options request waits for
+            self.dispatch(self.options_flow(0)[0])
+            return [self.run_flow(name, flows[name]) for name in self.args.flows.split(",")]
+        finally:
+            self.write_queue.stop()
+            self.listener_executor.shutdown(wait=False)
+            self.notion.stop()
+            self.slack.stop()
+            self._queue_dir.cleanup()
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(results: List[Dict[str, object]], benchmark: Benchmark) -> None:
+    rows = [{c: f"{v:.1f}" if isinstance(v, float) else str(v) for c, v in r.items()} for r in results]
+    columns = list(results[0].keys()) if len(results) > 0 else []
+    widths = {c: max(len(c), *(len(row[c]) for row in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(row[c].ljust(widths[c]) for c in columns))
+    print()
+    print(f"Notion API requests: {json.dumps(benchmark.notion.requests)} (429 responses: {benchmark.notion.rate_limited})")
+    print(f"Slack API requests: {json.dumps(benchmark.slack.requests)}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flows", default="options,select,submit,shortcut", help="comma-separated flows to run in order")
+    parser.add_argument("--rate", type=float, default=10, help="requests per second for each flow")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run each flow")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=200,
+        help="max requests in flight, including the ones waiting for the final view",
+    )
+    parser.add_argument("--final-view-timeout", type=float, default=60, help="seconds to wait for the final view")
+    parser.add_argument("--databases", type=int, default=200, help="the number of databases the fake Notion API has")
+    parser.add_argument("--notion-latency-ms", type=float, default=150)
+    parser.add_argument(
+        "--notion-rate-limited-ratio",
+        type=float,
+        default=0.0,
+        help="the fraction of Notion API calls answered with 429",
+    )
+    parser.add_argument("--slack-latency-ms", type=float, default=50)
+    parser.add_argument("--notion-writes-per-second", type=float, default=3)
+    parser.add_argument("--notion-write-workers", type=int, default=2)
+    parser.add_argument("--lazy-listener-workers", type=int, default=10)
+    parser.add_argument("--lazy-listener-overload-policy", default="reject", choices=["reject", "wait"])
+    parser.add_argument("--schema-prefetch-size", type=int, default=3)
+    parser.add_argument("--output", choices=["table", "json"], default="table")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.WARNING)
+    benchmark = Benchmark(parse_args())
+    results = benchmark.run()
+    if benchmark.args.output == "json":
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, benchmark)
@@ -1,10 +1,37 @@
+import asyncio
 import logging
+import multiprocessing
 import os
-from typing import Callable
-from slack_bolt import App, BoltContext
+from typing import Callable, Awaitable, Optional
+from slack_bolt import App, BoltContext, BoltResponse
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp, AsyncBoltContext
+from slack_bolt.authorization.async_authorize import AsyncInstallationStoreAuthorize
+from slack_bolt.authorization.authorize import InstallationStoreAuthorize
+from slack_bolt.oauth.async_callback_options import AsyncCallbackOptions
+from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
+from slack_bolt.oauth.callback_options import CallbackOptions, FailureArgs, SuccessArgs
+from slack_bolt.oauth.oauth_settings import OAuthSettings
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import ConnectionErrorRetryHandler, RateLimitErrorRetryHandler
+from slack_sdk.oauth.installation_store.sqlite3 import SQLite3InstallationStore
+from slack_sdk.oauth.state_store.sqlite3 import SQLite3OAuthStateStore
 
+from app.home_tab import HomeTabPublisher
+from app.idempotency import IdempotencyStore
+from app.installations import AsyncCachedAuthorize, CachedAuthorize, LruCache, NotionInstallationStore, NotionOAuthFlow
+from app.listener_executor import LazyListenerExecutor
+from app.metrics import Metrics, InstrumentedWebClient, start_metrics_server
+from app.notion_caches import NotionCachesRegistry
+from app.notion_clients import NotionClientRegistry, AsyncNotionClientRegistry
+from app.notion_csv_import import NotionCsvImporter
+from app.notion_ops import refresh_notion_database_directory, start_slack_notion_user_index_sync
+from app.notion_write_queue import NotionWriteQueue
+from app.rate_limiter import TokenBucketRegistry
+from app.shared_store import SharedStore, SqliteSharedStore
 from app.slack_events import register_slack_event_handlers
+from app.async_slack_events import register_async_slack_event_handlers
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,18 +39,335 @@ load_dotenv()
 slack_bot_token = os.environ.get("SLACK_BOT_TOKEN")
 slack_app_level_token = os.environ.get("SLACK_APP_TOKEN")
 notion_api_token = os.environ.get("NOTION_API_TOKEN")
+use_asyncio = os.environ.get("USE_ASYNCIO", "false").lower() in ("1", "true")
+metrics = Metrics()
+body_log_sample_rate = float(os.environ.get("SLACK_BODY_LOG_SAMPLE_RATE", "0"))
 
-app = App(token=slack_bot_token)
+# Lets the processes running this app share the data loaded from Notion
+shared_store_path = os.environ.get("SHARED_STORE_PATH")
+shared_store = SqliteSharedStore(shared_store_path) if shared_store_path is not None else SharedStore()
+notion_caches = NotionCachesRegistry(
+    database_directory_ttl_seconds=float(os.environ.get("NOTION_DATABASE_DIRECTORY_TTL_SECONDS", "60")),
+    schema_cache_ttl_seconds=float(os.environ.get("NOTION_SCHEMA_CACHE_TTL_SECONDS", "300")),
+    store=shared_store,
+)
 
+notion_client_options = dict(
+    max_connections=int(os.environ.get("NOTION_MAX_CONNECTIONS", "20")),
+    max_keepalive_connections=int(os.environ.get("NOTION_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    keepalive_expiry_seconds=float(os.environ.get("NOTION_KEEPALIVE_EXPIRY_SECONDS", "60")),
+    timeout_seconds=float(os.environ.get("NOTION_TIMEOUT_SECONDS", "30")),
+    http2=os.environ.get("NOTION_HTTP2", "false").lower() in ("1", "true"),
+    metrics=metrics,
+)
+notion_clients = NotionClientRegistry(**notion_client_options)
+# Shared by all the writers so that they respect the same per-integration rate limit
+notion_rate_limiters = TokenBucketRegistry(rate_per_second=float(os.environ.get("NOTION_WRITES_PER_SECOND", "3")))
+# Remembers the submissions already sent to Notion, so that Slack's retries don't create pages twice
+idempotency_store = IdempotencyStore(
+    ttl_seconds=float(os.environ.get("SUBMISSION_IDEMPOTENCY_TTL_SECONDS", "3600")),
+    store=shared_store,
+)
+notion_csv_importer = NotionCsvImporter(
+    notion_clients=notion_clients,
+    notion_caches=notion_caches,
+    rate_limiters=notion_rate_limiters,
+    concurrency=int(os.environ.get("NOTION_CSV_IMPORT_CONCURRENCY", "3")),
+    idempotency_store=idempotency_store,
+)
+notion_schema_prefetch_size = int(os.environ.get("NOTION_SCHEMA_PREFETCH_SIZE", "3"))
+notion_database_search_time_budget_seconds = float(os.environ.get("NOTION_DATABASE_SEARCH_TIME_BUDGET_SECONDS", "2"))
+# views.publish is rate-limited per workspace, and the modals need the same budget
+home_tab_publisher = HomeTabPublisher(
+    rate_limiters=TokenBucketRegistry(rate_per_second=float(os.environ.get("SLACK_HOME_TAB_PUBLISHES_PER_SECOND", "1"))),
+    store=shared_store,
+)
+notion_user_index_sync_interval_seconds = float(os.environ.get("SLACK_NOTION_USER_INDEX_SYNC_INTERVAL_SECONDS", "3600"))
 
-@app.middleware
-def attach_notion_token(context: BoltContext, next_: Callable):
-    context["notion_token"] = notion_api_token
-    next_()
+# When SLACK_CLIENT_ID is set, the app serves any number of Slack workspaces that install it via OAuth,
+# and each of them connects its own Notion workspace via NOTION_CLIENT_ID's OAuth flow
+slack_client_id = os.environ.get("SLACK_CLIENT_ID")
+slack_client_secret = os.environ.get("SLACK_CLIENT_SECRET")
+slack_scopes = os.environ.get(
+    "SLACK_SCOPES",
+    "commands,users:read,users:read.email,chat:write,files:read,channels:history,groups:history,im:history,mpim:history",
+).split(",")
+installation_store_path = os.environ.get("INSTALLATION_STORE_PATH", "installations.sqlite3")
+installation_cache_options = dict(
+    max_entries=int(os.environ.get("INSTALLATION_CACHE_SIZE", "1000")),
+    ttl_seconds=float(os.environ.get("INSTALLATION_CACHE_TTL_SECONDS", "300")),
+)
+slack_installation_store: Optional[SQLite3InstallationStore] = None
+notion_installation_store: Optional[NotionInstallationStore] = None
+notion_oauth_flow: Optional[NotionOAuthFlow] = None
+if slack_client_id is not None:
+    slack_installation_store = SQLite3InstallationStore(database=installation_store_path, client_id=slack_client_id)
+    notion_installation_store = NotionInstallationStore(installation_store_path, LruCache(**installation_cache_options))
+    if os.environ.get("NOTION_CLIENT_ID") is not None:
+        notion_oauth_flow = NotionOAuthFlow(
+            client_id=os.environ["NOTION_CLIENT_ID"],
+            client_secret=os.environ["NOTION_CLIENT_SECRET"],
+            redirect_uri=os.environ["NOTION_REDIRECT_URI"],
+            installation_store=notion_installation_store,
+        )
+# The write queue's clients read long threads page by page, so they wait for Retry-After instead of giving up on a 429
+slack_retry_handlers = [ConnectionErrorRetryHandler(), RateLimitErrorRetryHandler(max_retry_count=5)]
+default_slack_client = InstrumentedWebClient(token=slack_bot_token, retry_handlers=slack_retry_handlers, metrics=metrics)
+slack_clients = LruCache(**installation_cache_options)
 
 
-register_slack_event_handlers(app)
+def resolve_notion_token(enterprise_id: Optional[str], team_id: Optional[str]) -> Optional[str]:
+    if notion_oauth_flow is None:
+        # Without Notion OAuth, all the Slack workspaces use NOTION_API_TOKEN
+        return notion_api_token
+    # A Slack workspace that has not connected its own Notion must never get another tenant's token
+    return notion_installation_store.find_token(enterprise_id, team_id)
+
+
+def resolve_slack_client(enterprise_id: Optional[str], team_id: Optional[str]) -> WebClient:
+    if slack_installation_store is None:
+        return default_slack_client
+    client = slack_clients.get((enterprise_id, team_id))
+    if client is None:
+        bot = slack_installation_store.find_bot(enterprise_id=enterprise_id, team_id=team_id)
+        if bot is None and enterprise_id is not None:
+            bot = slack_installation_store.find_bot(enterprise_id=enterprise_id, team_id=None, is_enterprise_install=True)
+        client = InstrumentedWebClient(
+            token=bot.bot_token if bot is not None else None,
+            retry_handlers=slack_retry_handlers,
+            metrics=metrics,
+        )
+        slack_clients.put((enterprise_id, team_id), client)
+    return client
+
+
+def start_notion_installation_jobs(notion_token: str):
+    """Loads a Notion installation's caches saved by the last run, and starts keeping them fresh in the background."""
+    caches = notion_caches.get(notion_token)
+    if not caches.begin_background_sync():
+        return
+    caches.load_snapshots()
+    logger = logging.getLogger(__name__)
+    refresh_notion_database_directory(notion_clients.get(notion_token), caches.database_directory, logger)
+
+
+def start_slack_workspace_jobs(notion_token: str, bot_token: str, enterprise_id: Optional[str], team_id: Optional[str]):
+    """Starts syncing the user index of a Slack workspace with the Notion installation it uses."""
+    caches = notion_caches.get(notion_token)
+    if not caches.begin_user_index_sync(enterprise_id, team_id):
+        return
+    index = caches.user_index(enterprise_id, team_id)
+    index.load_snapshot()
+    start_slack_notion_user_index_sync(
+        WebClient(token=bot_token),
+        notion_clients.get(notion_token),
+        index,
+        interval_seconds=notion_user_index_sync_interval_seconds,
+        logger=logging.getLogger(__name__),
+    )
+
+
+def redirect_to_notion_oauth(args: SuccessArgs) -> BoltResponse:
+    url = notion_oauth_flow.build_authorize_url(args.installation.enterprise_id, args.installation.team_id)
+    return BoltResponse(status=302, body="", headers={"Location": url})
+
+
+async def async_redirect_to_notion_oauth(args: SuccessArgs) -> BoltResponse:
+    return redirect_to_notion_oauth(args)
+
+
+def render_installation_failure(args: FailureArgs) -> BoltResponse:
+    return BoltResponse(status=args.suggested_status_code, body=f"Failed to install this app ({args.reason})")
+
+
+async def async_render_installation_failure(args: FailureArgs) -> BoltResponse:
+    return render_installation_failure(args)
+
+
+def create_notion_write_queue() -> NotionWriteQueue:
+    return NotionWriteQueue(
+        path=os.environ.get("NOTION_WRITE_QUEUE_PATH", "notion_write_queue.sqlite3"),
+        notion_clients=notion_clients,
+        notion_caches=notion_caches,
+        resolve_notion_token=resolve_notion_token,
+        resolve_slack_client=resolve_slack_client,
+        rate_limiters=notion_rate_limiters,
+        workers=int(os.environ.get("NOTION_WRITE_WORKERS", "2")),
+        idempotency_store=idempotency_store,
+        retention_seconds=float(os.environ.get("NOTION_WRITE_QUEUE_RETENTION_SECONDS", str(86400 * 7))),
+    )
+
+
+def create_app(notion_write_queue: NotionWriteQueue) -> App:
+    listener_executor = LazyListenerExecutor(
+        max_workers=int(os.environ.get("LAZY_LISTENER_WORKERS", "10")),
+        max_queue_size=int(os.environ.get("LAZY_LISTENER_MAX_QUEUE_SIZE", "100")),
+        overload_policy=os.environ.get("LAZY_LISTENER_OVERLOAD_POLICY", "reject"),
+        metrics=metrics,
+    )
+    if slack_installation_store is None:
+        app = App(token=slack_bot_token, listener_executor=listener_executor)
+    else:
+        app = App(
+            oauth_settings=OAuthSettings(
+                client_id=slack_client_id,
+                client_secret=slack_client_secret,
+                scopes=slack_scopes,
+                installation_store=slack_installation_store,
+                installation_store_bot_only=True,
+                state_store=SQLite3OAuthStateStore(database=installation_store_path, expiration_seconds=600),
+                callback_options=(
+                    CallbackOptions(success=redirect_to_notion_oauth, failure=render_installation_failure)
+                    if notion_oauth_flow is not None
+                    else None
+                ),
+            ),
+            authorize=CachedAuthorize(
+                InstallationStoreAuthorize(
+                    logger=logging.getLogger(__name__),
+                    installation_store=slack_installation_store,
+                    client_id=slack_client_id,
+                    client_secret=slack_client_secret,
+                    bot_only=True,
+                ),
+                LruCache(**installation_cache_options),
+            ),
+            listener_executor=listener_executor,
+        )
+
+    @app.middleware
+    def attach_notion_token(context: BoltContext, next_: Callable):
+        notion_token = resolve_notion_token(context.enterprise_id, context.team_id)
+        context["notion_token"] = notion_token
+        if notion_token is not None and context.bot_token is not None:
+            start_notion_installation_jobs(notion_token)
+            start_slack_workspace_jobs(notion_token, context.bot_token, context.enterprise_id, context.team_id)
+        next_()
+
+    register_slack_event_handlers(
+        app,
+        notion_clients,
+        notion_caches,
+        notion_write_queue,
+        notion_csv_importer,
+        notion_rate_limiters,
+        listener_executor=listener_executor,
+        schema_prefetch_size=notion_schema_prefetch_size,
+        metrics=metrics,
+        body_log_sample_rate=body_log_sample_rate,
+        options_time_budget_seconds=notion_database_search_time_budget_seconds,
+        home_tab_publisher=home_tab_publisher,
+    )
+    return app
+
+
+def create_async_app(notion_write_queue: NotionWriteQueue) -> AsyncApp:
+    if slack_installation_store is None:
+        app = AsyncApp(token=slack_bot_token)
+    else:
+        app = AsyncApp(
+            oauth_settings=AsyncOAuthSettings(
+                client_id=slack_client_id,
+                client_secret=slack_client_secret,
+                scopes=slack_scopes,
+                installation_store=slack_installation_store,
+                installation_store_bot_only=True,
+                state_store=SQLite3OAuthStateStore(database=installation_store_path, expiration_seconds=600),
+                callback_options=(
+                    AsyncCallbackOptions(success=async_redirect_to_notion_oauth, failure=async_render_installation_failure)
+                    if notion_oauth_flow is not None
+                    else None
+                ),
+            ),
+            authorize=AsyncCachedAuthorize(
+                AsyncInstallationStoreAuthorize(
+                    logger=logging.getLogger(__name__),
+                    installation_store=slack_installation_store,
+                    client_id=slack_client_id,
+                    client_secret=slack_client_secret,
+                    bot_only=True,
+                ),
+                LruCache(**installation_cache_options),
+            ),
+        )
+
+    @app.middleware
+    async def attach_notion_token(context: AsyncBoltContext, next_: Callable[[], Awaitable[None]]):
+        notion_token = resolve_notion_token(context.enterprise_id, context.team_id)
+        context["notion_token"] = notion_token
+        if notion_token is not None and context.bot_token is not None:
+            # The background syncs are thread-based even in asyncio mode
+            start_notion_installation_jobs(notion_token)
+            start_slack_workspace_jobs(notion_token, context.bot_token, context.enterprise_id, context.team_id)
+        await next_()
+
+    async_notion_clients = AsyncNotionClientRegistry(**notion_client_options)
+    register_async_slack_event_handlers(
+        app,
+        async_notion_clients,
+        notion_caches,
+        notion_write_queue,
+        notion_csv_importer,
+        notion_rate_limiters,
+        schema_prefetch_size=notion_schema_prefetch_size,
+        metrics=metrics,
+        body_log_sample_rate=body_log_sample_rate,
+        options_time_budget_seconds=notion_database_search_time_budget_seconds,
+        home_tab_publisher=home_tab_publisher,
+    )
+    return app
+
+
+async def start_async_socket_mode(notion_write_queue: NotionWriteQueue):
+    await AsyncSocketModeHandler(create_async_app(notion_write_queue), slack_app_level_token).start_async()
+
+
+def configure_logging():
+    logging.basicConfig(format="%(asctime)s %(message)s", level=os.environ.get("LOG_LEVEL", "INFO").upper())
+
+
+def start_background_jobs(metrics_port: Optional[int] = None) -> NotionWriteQueue:
+    """Starts what every process of this app runs in the background, both in Socket Mode and HTTP mode."""
+    if metrics_port is not None:
+        start_metrics_server(metrics, metrics_port)
+    # Writes to Notion always go through the thread-based queue, even in asyncio mode
+    notion_write_queue = create_notion_write_queue()
+    notion_write_queue.start()
+    home_tab_publisher.start()
+    if notion_api_token is not None:
+        # With OAuth installations, this starts when each installation is used for the first time instead.
+        # The user index needs the Slack workspace of a request, so it starts with the first one.
+        start_notion_installation_jobs(notion_api_token)
+    return notion_write_queue
+
+
+def run_socket_mode(metrics_port: Optional[int] = None):
+    configure_logging()
+    notion_write_queue = start_background_jobs(metrics_port)
+    if use_asyncio:
+        asyncio.run(start_async_socket_mode(notion_write_queue))
+    else:
+        SocketModeHandler(create_app(notion_write_queue), slack_app_level_token).start()
+
 
 if __name__ == "__main__":
-    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
-    SocketModeHandler(app, slack_app_level_token).start()
+    connections = int(os.environ.get("SLACK_SOCKET_MODE_CONNECTIONS", "1"))
+    metrics_port = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") is not None else None
+    if connections <= 1:
+        run_socket_mode(metrics_port)
+    else:
+        # Slack spreads the requests over the open connections, and each of them runs in its own process
+        # so that they can use as many CPU cores. Spawned processes start with their own clients and caches.
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=run_socket_mode,
+                args=(metrics_port + i if metrics_port is not None else None,),
+                name=f"socket-mode-{i}",
+            )
+            for i in range(connections)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,22 @@
+# Runs this app in HTTP mode with a multi-process WSGI server, for example:
+#
+# pip install gunicorn
+# gunicorn --workers 4 --threads 10 --bind 0.0.0.0:3000 wsgi:application
+#
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+from slack_bolt.adapter.wsgi import SlackRequestHandler
+
+from main import configure_logging, create_app, notion_oauth_flow, start_background_jobs
+
+configure_logging()
+slack_request_handler = SlackRequestHandler(create_app(start_background_jobs()))
+
+
+def application(environ, start_response):
+    if notion_oauth_flow is not None and environ.get("PATH_INFO") == notion_oauth_flow.redirect_uri_path:
+        status, text = notion_oauth_flow.handle_callback(dict(parse_qsl(environ.get("QUERY_STRING", ""))))
+        start_response(f"{status} {HTTPStatus(status).phrase}", [("Content-Type", "text/plain;charset=utf-8")])
+        return [text.encode("utf-8")]
+    return slack_request_handler(environ, start_response)